@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+
+# benchmark.py
+#
+# Copyright (c) 2021-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
+# Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
+
+from argparse import ArgumentParser
+from sys import exit, executable, version
+from os import getgid
+from grp import getgrgid
+from getpass import getuser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from json import dumps
+from uuid import uuid4 as generate_uuid
+from contextlib import contextmanager
+from threading import Thread
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from subprocess import run, DEVNULL, PIPE
+from shutil import copy2
+
+import external_commands
+
+DESCRIPTION = "benchmark hot paths of external_commands.py on a synthetic Clearswift gateway"
+
+DEFAULT_FILES = 1000
+DEFAULT_SIZE = 1024 * 1024
+DEFAULT_ITEMS = 100000
+DEFAULT_COMMANDS = 3
+DEFAULT_PEERS = 3
+DEFAULT_REPEAT = 3
+DEFAULT_WORKERS = 8
+
+COUNT_MEDIA_TYPES = 200
+COUNT_AREAS = 50
+
+TEMPLATE_RULE = '<?xml version="1.0" encoding="UTF-8" standalone="no"?><ExecutablePolicyRule name={name} siteSpecific="false" uuid="{uuid}"><WhatToFind/></ExecutablePolicyRule>'
+TEMPLATE_MEDIA_TYPE = '<MediaType drm="true" encrypted="true" mnemonic="{mnemonic}" notProtected="true" signed="true" signedAndEncrypted="true" uuid="{uuid}"/>'
+TEMPLATE_FILTER = '<Filter name="Filter {number}" uuid="{uuid}"><Pattern>{pattern}</Pattern></Filter>'
+TEMPLATE_AREA = '<MessageArea name="Area {number}" uuid="{uuid}"/>'
+TEMPLATE_DISPOSALS = '<?xml version="1.0" encoding="UTF-8" standalone="no"?><DisposalCollection><None uuid="{none}"/><Deliver uuid="{deliver}"/><Reject uuid="{reject}"/><Drop uuid="{drop}"/><NDR uuid="{ndr}"/><TagAndDeliver uuid="{tag}"/>{areas}</DisposalCollection>'
+
+class HandlerQuiet(SimpleHTTPRequestHandler):
+    """
+    HTTP/1.1 (keep-alive) request handler without request logging.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+def write_file(file_target, content):
+    """
+    Write file, creating parent directories.
+
+    :type file_target: Path
+    :type content: str
+    """
+    file_target.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(file_target, "w") as f:
+        f.write(content)
+
+def generate_lexical(directory, count, size):
+    """
+    Generate lexical expression list files, every tenth one with a single phrase of the given size (like stored scripts).
+
+    :type directory: Path
+    :type count: int
+    :type size: int
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+
+    for number in range(count):
+        uuid = generate_uuid()
+
+        phrase = "x" * (size if number % 10 == 0 else 64)
+
+        with open(directory / f"{uuid}.xml", "w") as f:
+            f.write(external_commands.TEMPLATE_LIST_LEXICAL.substitute(name=external_commands.quoteattr(f"List {number}"), uuid=uuid, count=1, items=external_commands.TEMPLATE_PHRASE.substitute(item=external_commands.quoteattr(phrase), uuid=generate_uuid())))
+
+def generate_gateway(root, count, size):
+    """
+    Generate synthetic Clearswift gateway under root directory with policy rules, lists of every type, media types, disposal actions and status file.
+
+    :type root: Path
+    :type count: int
+    :type size: int
+    :rtype: TupleGateway
+    """
+    gateway = external_commands.get_gateway(root=root, user=getuser(), group=getgrgid(getgid()).gr_name)
+
+    for (type_list, info) in external_commands.LIST_INFO.items():
+        directory = gateway.directories[type_list]
+
+        if type_list == "lexical":
+            generate_lexical(directory, count, size)
+        else:
+            directory.mkdir(parents=True, exist_ok=True)
+
+            for number in range(count):
+                uuid = generate_uuid()
+
+                with open(directory / f"{uuid}.xml", "w") as f:
+                    f.write(info.template_list.substitute(name=external_commands.quoteattr(f"List {number}"), uuid=uuid, count=1, items=info.template_item.substitute(item="dummy", uuid=generate_uuid())))
+
+    directory = gateway.directories[external_commands.TYPE_RULE]
+
+    directory.mkdir(parents=True, exist_ok=True)
+
+    for number in range(count):
+        uuid = generate_uuid()
+
+        write_file(directory / f"{uuid}.xml", TEMPLATE_RULE.format(name=external_commands.quoteattr(f"Rule {number}"), uuid=uuid))
+
+    media_types = "".join([ TEMPLATE_MEDIA_TYPE.format(mnemonic=f"MT{number}", uuid=generate_uuid()) for number in range(COUNT_MEDIA_TYPES) ])
+
+    # real mediatypes.xml files contain large sections after the media types
+    filters = "".join([ TEMPLATE_FILTER.format(number=number, uuid=generate_uuid(), pattern="0" * 256) for number in range(COUNT_MEDIA_TYPES * 10) ])
+
+    write_file(gateway.file_mediatypes, f'<?xml version="1.0" encoding="UTF-8" standalone="no"?><MediaTypeConfiguration><MediaTypes>{media_types}</MediaTypes><Filters>{filters}</Filters></MediaTypeConfiguration>')
+
+    areas = "".join([ TEMPLATE_AREA.format(number=number, uuid=generate_uuid()) for number in range(COUNT_AREAS) ])
+
+    write_file(gateway.file_disposal, TEMPLATE_DISPOSALS.format(none=generate_uuid(), deliver=generate_uuid(), reject=generate_uuid(), drop=generate_uuid(), ndr=generate_uuid(), tag=generate_uuid(), areas=areas))
+
+    write_file(gateway.file_status, '<?xml version="1.0" encoding="UTF-8" standalone="no"?><ConfigurationTrail changesMade="false" version="1"/>')
+
+    gateway.file_apply.parent.mkdir(parents=True, exist_ok=True)
+
+    external_commands.get_rooted(root, external_commands.DEFAULT_DIRECTORY).mkdir(parents=True, exist_ok=True)
+
+    return gateway
+
+def generate_config(command):
+    """
+    Generate external command configuration with rules using lists, Hold Areas and parameters.
+
+    :type command: str
+    :rtype: str
+    """
+    dict_config = dict()
+
+    for number in range(2):
+        dict_config[f"{command} rule {number}"] = {
+            external_commands.KEY_MEDIA_TYPES: { f"MT{media_type}": [ external_commands.SUBTYPE_ENCRYPTED, external_commands.SUBTYPE_NOT_PROTECTED ] for media_type in range(5) },
+            external_commands.KEY_RESPONSES: { external_commands.ACTION_NONE: "none", external_commands.ACTION_DETECTED: "detected", external_commands.ACTION_ERROR: "error" },
+            external_commands.KEY_DISPOSAL_ACTIONS: { external_commands.KEY_DETECTED: { external_commands.KEY_PRIMARY: f"hold:{command} {number}", external_commands.KEY_SECONDARY: external_commands.DISPOSAL_NONE } },
+            external_commands.KEY_LIST_ADDRESS: [ f"{command} addresses {number}" ],
+            external_commands.KEY_LIST_URL: [ f"{command} URLs {number}" ],
+            external_commands.KEY_LIST_LEXICAL: [ f"{command} expressions {number}" ],
+            external_commands.KEY_CONFIG: { f"parameter_{parameter}": { "type": "int", "description": f"parameter {parameter}", "value": parameter } for parameter in range(10) }
+        }
+
+    return dumps(dict_config)
+
+def generate_repo(directory, commands, size):
+    """
+    Generate repo layout with readme, catalog, external command script, library and external commands.
+
+    :type directory: Path
+    :type commands: int
+    :type size: int
+    :rtype: list
+    """
+    list_command = [ f"command_{number}" for number in range(commands) ]
+
+    write_file(directory / external_commands.FILE_README, "# External commands\n\n## External commands\n{}\n\n## Other\n".format("\n".join([ f"- {command}: benchmark command {command}" for command in list_command ])))
+    write_file(directory / external_commands.FILE_COMMAND, f"# {external_commands.FILE_COMMAND}\n" + "pass\n" * (size // 50))
+    write_file(directory / external_commands.FILE_LIBRARY, f"# {external_commands.FILE_LIBRARY}\n" + "pass\n" * (size // 5))
+
+    for command in list_command:
+        write_file(directory / command / f"{command}.py", f"# {command}.py V1.0.0\n" + "pass\n" * (size // 50))
+        write_file(directory / command / external_commands.FILE_CONFIG, generate_config(command))
+        write_file(directory / command / external_commands.FILE_README, f"# {command}\n")
+
+    write_file(directory / external_commands.FILE_CATALOG, dumps(external_commands.build_catalog(directory), indent=4))
+
+    return list_command
+
+@contextmanager
+def serve_repo(directory):
+    """
+    Serve repo directory from local HTTP server and yield its URL.
+
+    :type directory: Path
+    :rtype: generator
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(HandlerQuiet, directory=str(directory)))
+
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def time_best(function, repeat):
+    """
+    Return best wall time in seconds of function and its result.
+
+    :type function: function
+    :type repeat: int
+    :rtype: tuple
+    """
+    best = None
+
+    for _ in range(repeat):
+        start = perf_counter()
+
+        result = function()
+
+        elapsed = perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return (best, result)
+
+def benchmark_names(directory, repeat):
+    """
+    Benchmark xml.sax name parsing against head-only name sniffing.
+
+    :type directory: Path
+    :type repeat: int
+    :rtype: dict
+    """
+    list_file = sorted(directory.iterdir())
+
+    (time_sax, set_sax) = time_best(lambda: { external_commands.parse_name(file_xml, "TextualAnalysis")[0] for file_xml in list_file }, repeat)
+    (time_sniff, set_sniff) = time_best(lambda: { external_commands.read_name(file_xml, "TextualAnalysis")[0] for file_xml in list_file }, repeat)
+
+    if set_sax != set_sniff:
+        raise Exception("Name sets differ between xml.sax and sniffing")
+
+    return { "sax": time_sax, "sniff": time_sniff, "speedup": time_sax / time_sniff }
+
+def benchmark_scan(directory, workers, repeat):
+    """
+    Benchmark serial against thread pool directory scanning (without persistent index).
+
+    :type directory: Path
+    :type workers: int
+    :type repeat: int
+    :rtype: dict
+    """
+    (time_serial, dict_serial) = time_best(lambda: external_commands.scan_directory(directory, "TextualAnalysis", dict()), repeat)
+    (time_parallel, dict_parallel) = time_best(lambda: external_commands.scan_directory(directory, "TextualAnalysis", dict(), workers=workers), repeat)
+
+    if { entry.name for entry in dict_serial.values() } != { entry.name for entry in dict_parallel.values() }:
+        raise Exception("Name sets differ between serial and parallel scanning")
+
+    return { "workers": workers, "serial": time_serial, "parallel": time_parallel, "speedup": time_serial / time_parallel }
+
+def benchmark_get_names(gateway, workers, repeat):
+    """
+    Benchmark get_names() for all policy directories with cold and warm persistent index.
+
+    :type gateway: TupleGateway
+    :type workers: int
+    :type repeat: int
+    :rtype: dict
+    """
+    list_location = [ (gateway.directories[external_commands.TYPE_RULE], external_commands.TAG_RULE) ] + [ (gateway.directories[type_list], info.tag) for (type_list, info) in external_commands.LIST_INFO.items() ]
+
+    def get_names():
+        return [ external_commands.get_names(directory, tag, workers=workers) for (directory, tag) in list_location ]
+
+    def get_names_cold():
+        external_commands.FILE_INDEX.unlink(missing_ok=True)
+
+        return get_names()
+
+    (time_cold, list_cold) = time_best(get_names_cold, repeat)
+    (time_warm, list_warm) = time_best(get_names, repeat)
+
+    if list_cold != list_warm:
+        raise Exception("Name sets differ between cold and warm index")
+
+    return { "cold": time_cold, "warm": time_warm }
+
+def benchmark_snapshot(gateway, repeat):
+    """
+    Benchmark reading media types and disposal actions with cold and warm snapshot.
+
+    :type gateway: TupleGateway
+    :type repeat: int
+    :rtype: dict
+    """
+    def read_gateway():
+        return (external_commands.get_media_types(gateway), external_commands.get_disposal_actions(gateway))
+
+    def read_gateway_cold():
+        external_commands.FILE_SNAPSHOT.unlink(missing_ok=True)
+
+        return read_gateway()
+
+    (time_cold, result_cold) = time_best(read_gateway_cold, repeat)
+    (time_warm, result_warm) = time_best(read_gateway, repeat)
+
+    if result_cold != result_warm:
+        raise Exception("Media types or disposal actions differ between cold and warm snapshot")
+
+    return { "cold": time_cold, "warm": time_warm }
+
+def benchmark_create_list(gateway, items, repeat):
+    """
+    Benchmark creating address list and lexical expression list with many items.
+
+    :type gateway: TupleGateway
+    :type items: int
+    :type repeat: int
+    :rtype: dict
+    """
+    policy_index = external_commands.PolicyIndex(gateway)
+
+    (time_address, _) = time_best(lambda: external_commands.create_list(policy_index, "address", "Benchmark addresses", [ f"user{number}@example.com" for number in range(items) ]), repeat)
+    (time_lexical, _) = time_best(lambda: external_commands.create_list(policy_index, "lexical", "Benchmark expressions", (f"expression {number}" for number in range(items))), repeat)
+    (time_merge, _) = time_best(lambda: external_commands.create_list(policy_index, "lexical", "Benchmark expressions", [ f"expression {number}" for number in range(items) ], merge=True), repeat)
+
+    policy_index.save()
+
+    return { "items": items, "address": time_address, "lexical": time_lexical, "lexical_merge_unchanged": time_merge }
+
+def benchmark_parse_config(repeat):
+    """
+    Benchmark parsing external command configuration.
+
+    :type repeat: int
+    :rtype: dict
+    """
+    configuration = generate_config("benchmark")
+
+    (time_parse, _) = time_best(lambda: [ external_commands.parse_config("benchmark", configuration) for _ in range(100) ], repeat)
+
+    return { "per_config": time_parse / 100 }
+
+def run_script(script, list_gateway, repo, list_argument):
+    """
+    Run copy of external_commands.py against synthetic gateways and repo and return wall time in seconds.
+
+    :type script: Path
+    :type list_gateway: list
+    :type repo: str
+    :type list_argument: list
+    :rtype: float
+    """
+    list_root = [ argument for gateway in list_gateway for argument in ("--root", str(gateway.root)) ]
+
+    start = perf_counter()
+
+    result = run([ executable, str(script), *list_root, "--owner", f"{list_gateway[0].user}:{list_gateway[0].group}", "--repo", repo, "--no-cache", *list_argument ], stdout=DEVNULL, stderr=PIPE)
+
+    elapsed = perf_counter() - start
+
+    if result.returncode:
+        raise Exception(f"Command {' '.join(list_argument)} failed: {result.stderr.decode().strip()}")
+
+    return elapsed
+
+def benchmark_end_to_end(script, list_gateway, repo, list_command):
+    """
+    Benchmark end-to-end install and update on one or more gateway roots against local repo (without installing dependencies).
+
+    :type script: Path
+    :type list_gateway: list
+    :type repo: str
+    :type list_command: list
+    :rtype: dict
+    """
+    time_install = run_script(script, list_gateway, repo, [ "install", "--no-dependencies", *list_command ])
+    time_update = run_script(script, list_gateway, repo, [ "update", "--no-dependencies" ])
+
+    return { "roots": len(list_gateway), "commands": len(list_command), "install": time_install, "update": time_update }
+
+def main(args):
+    result = { "python": version, "files": args.files, "size": args.size }
+
+    file_index = external_commands.FILE_INDEX
+    file_snapshot = external_commands.FILE_SNAPSHOT
+
+    try:
+        with TemporaryDirectory() as directory:
+            directory = Path(directory)
+
+            # keep the persistent index of the benchmarked functions away from the real one
+            external_commands.FILE_INDEX = directory / "index.json"
+            external_commands.FILE_SNAPSHOT = directory / "snapshot.json"
+
+            gateway = generate_gateway(directory / "root", args.files, args.size)
+
+            dir_lexical = gateway.directories["lexical"]
+
+            result["read_name"] = benchmark_names(dir_lexical, args.repeat)
+            result["scan_directory"] = benchmark_scan(dir_lexical, args.workers, args.repeat)
+            result["get_names"] = benchmark_get_names(gateway, args.workers, args.repeat)
+            result["snapshot"] = benchmark_snapshot(gateway, args.repeat)
+            result["create_list"] = benchmark_create_list(gateway, args.items, args.repeat)
+            result["parse_config"] = benchmark_parse_config(args.repeat)
+
+            if args.commands:
+                list_command = generate_repo(directory / "repo", args.commands, args.size)
+
+                # the script keeps index, snapshot and catalog next to itself, so a copy is run to keep them away from the real ones
+                script = directory / "bin" / Path(external_commands.__file__).name
+
+                script.parent.mkdir()
+
+                copy2(external_commands.__file__, script)
+
+                with serve_repo(directory / "repo") as repo:
+                    result["end_to_end"] = benchmark_end_to_end(script, [ gateway, ], repo, list_command)
+
+                    if args.peers > 1:
+                        list_gateway = [ generate_gateway(directory / f"peer{number}", args.files, args.size) for number in range(args.peers) ]
+
+                        result["end_to_end_peers"] = benchmark_end_to_end(script, list_gateway, repo, list_command)
+    except Exception as ex:
+        external_commands.eprint(ex)
+
+        return external_commands.ReturnCode.ERROR
+    finally:
+        external_commands.FILE_INDEX = file_index
+        external_commands.FILE_SNAPSHOT = file_snapshot
+
+    output = dumps(result, indent=4)
+
+    if args.output is None:
+        print(output)
+    else:
+        try:
+            with open(args.output, "w") as f:
+                f.write(output)
+        except Exception:
+            external_commands.eprint(f"Cannot write output file '{args.output}'")
+
+            return external_commands.ReturnCode.ERROR
+
+    return external_commands.ReturnCode.OK
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=DESCRIPTION)
+
+    parser.add_argument("-f", "--files", metavar="FILES", type=int, default=DEFAULT_FILES, help=f"number of generated policy rule files and list files per list type (default={DEFAULT_FILES})")
+    parser.add_argument("-s", "--size", metavar="SIZE", type=int, default=DEFAULT_SIZE, help=f"size in bytes of the phrase stored in every tenth lexical expression list file (default={DEFAULT_SIZE})")
+    parser.add_argument("-n", "--items", metavar="ITEMS", type=int, default=DEFAULT_ITEMS, help=f"number of items of created lists (default={DEFAULT_ITEMS})")
+    parser.add_argument("-c", "--commands", metavar="COMMANDS", type=int, default=DEFAULT_COMMANDS, help=f"number of external commands installed end-to-end, 0 to skip (default={DEFAULT_COMMANDS})")
+    parser.add_argument("-p", "--peers", metavar="PEERS", type=int, default=DEFAULT_PEERS, help=f"number of gateway roots installed in parallel end-to-end, 1 to skip (default={DEFAULT_PEERS})")
+    parser.add_argument("-w", "--workers", metavar="WORKERS", type=int, default=DEFAULT_WORKERS, help=f"number of threads for parallel scanning (default={DEFAULT_WORKERS})")
+    parser.add_argument("-r", "--repeat", metavar="REPEAT", type=int, default=DEFAULT_REPEAT, help=f"number of repetitions, the best time is reported (default={DEFAULT_REPEAT})")
+    parser.add_argument("-o", "--output", metavar="OUTPUT", type=Path, help="write JSON results to file instead of stdout")
+
+    exit(main(parser.parse_args()))
@@ -6,38 +6,107 @@
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
 from argparse import ArgumentParser
+from re import compile as compile_regex, DOTALL
 from enum import unique, IntEnum
-from sys import stderr, exit, executable
+from sys import stdin, stderr, exit, executable
 from pathlib import Path
 from string import Template
 from collections import namedtuple, Counter
+from itertools import islice
+from heapq import merge
+from csv import reader as csv_reader
 from xml.sax import make_parser, handler, SAXException
 from xml.sax.saxutils import quoteattr, escape
 from uuid import uuid4 as generate_uuid
-from os import chmod, SEEK_END
-from subprocess import run, DEVNULL
-from shutil import chown
-from json import loads
-from urllib.request import urlopen, urlretrieve
+from os import chmod, getpid, environ, fork, setsid, dup2, _exit
+from threading import local, Lock, get_ident
+from fcntl import flock, LOCK_EX
+from syslog import syslog, LOG_ERR, LOG_INFO
+from stat import S_ISREG
+from subprocess import run, DEVNULL, PIPE
+from importlib.metadata import distributions
+from shutil import chown, copyfileobj
+from tempfile import TemporaryFile, TemporaryDirectory
+from tarfile import open as open_tar, TarInfo
+from io import BytesIO
+from json import loads, dumps
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from queue import SimpleQueue, Empty
+from time import sleep, perf_counter, time
+from contextlib import contextmanager, ExitStack
+from cProfile import Profile
+from http.client import HTTPConnection, HTTPSConnection
+from urllib.parse import urlsplit, urljoin
+from urllib.request import urlopen
 
 DESCRIPTION = "install and update external commands for Clearswift SEG 5"
 
 DEFAULT_DIRECTORY = Path("/opt/netcon_scripts")
+DEFAULT_ROOT = Path("/")
 DEFAULT_INTERPRETER = Path(executable)
+DEFAULT_WORKERS = 8
+DEFAULT_CONNECTIONS = 4
+DEFAULT_MEMORY = 100000
+DEFAULT_BATCH = 10000
+DEFAULT_DEBOUNCE = 10
+
+FORMAT_TABLE = "table"
+FORMAT_JSON = "json"
+
+FILE_INDEX = Path(__file__).resolve().with_name("external_commands.index.json")
+DEFAULT_CACHE = Path(__file__).resolve().with_name("external_commands.cache")
+VERSION_INDEX = 1
+FILE_SNAPSHOT = Path(__file__).resolve().with_name("external_commands.snapshot.json")
+VERSION_SNAPSHOT = 1
+LOCK_SNAPSHOT = Lock()
+FILE_CATALOG_LOCAL = Path(__file__).resolve().with_name("external_commands.catalog.json")
+VERSION_CATALOG = 3
+INTERVAL_CATALOG = 86400
+FILE_HASHES = Path(__file__).resolve().with_name("external_commands.hashes.json")
+VERSION_HASHES = 1
+VERSION_BUNDLE = 1
+
+SIZE_SNIFF = 4096
+SIZE_BUFFER = 1024 * 1024
+
+REGEX_PROLOG = compile_regex(rb"(?:\s|<\?.*?\?>|<!--.*?-->|<!DOCTYPE[^>]*>)*<", DOTALL)
+REGEX_ENCODING = compile_regex(rb"""^<\?xml[^>]*?\sencoding\s*=\s*["']([^"']+)["']""")
+REGEX_ELEMENT = compile_regex(rb"""((?:\s+[^\s=/>]+\s*=\s*(?:"[^"<]*"|'[^'<]*'))*)\s*/?>""")
+REGEX_ATTRIBUTE = compile_regex(rb"""\s([^\s=/>]+)\s*=\s*(?:"([^"<]*)"|'([^'<]*)')""")
+REGEX_REFERENCE = compile_regex(r"&(?:#([0-9]+)|#x([0-9a-fA-F]+)|(amp|lt|gt|quot|apos));")
+
+REGEX_INVALID_XML = compile_regex("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+REGEX_WHITESPACE = compile_regex(r"\s")
+
+XML_ENTITY = { "amp": "&", "lt": "<", "gt": ">", "quot": '"', "apos": "'" }
 
 FILE_README = "README.md"
 FILE_CONFIG = "config.json"
 FILE_COMMAND = "run_command.py"
+FILE_LIBRARY = "command_library.py"
+FILE_CATALOG = "catalog.json"
+FILE_CLIENT = "command_client.py"
+FILE_SERVER = "command_server.py"
+FILE_SERVER_CONFIG = "command_server.json"
+FILE_BUNDLE = "bundle.json"
+DIR_BUNDLE_FILES = "files"
+DIR_BUNDLE_WHEELS = "wheels"
 
 URL_REPO = "https://raw.githubusercontent.com/netcon-consulting/clearswift-external-commands/master"
-URL_README = f"{URL_REPO}/{FILE_README}"
-URL_COMMAND = f"{URL_REPO}/{FILE_COMMAND}"
-URL_LIBRARY = f"{URL_REPO}/command_library.py"
+
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_REDIRECTS = 5
 
 NAME_LIBRARY = "External command library"
 NAME_COMMAND = "External command - {}"
 NAME_CONFIG = "Config - {}"
 
+TYPE_RULE = "rule"
+TAG_RULE = "ExecutablePolicyRule"
+TAG_DISPOSAL_END = b"</DisposalCollection>"
+
 DIR_UICONFIG = Path("/var/cs-gateway/uicfg")
 DIR_POLICY = DIR_UICONFIG / "policy"
 DIR_RULES = DIR_POLICY / "rules"
@@ -51,9 +120,22 @@ FILE_MEDIATYPES = Path("/opt/cs-gateway/cfg/ui/mediatypes.xml")
 FILE_STATUS = DIR_UICONFIG / "trail.xml"
 FILE_APPLY = Path("/opt/cs-gateway/upgradesignals/applyconfiguration")
 
+DIR_STATE = Path("/var/lib/external_commands")
+FILE_LOCK = DIR_STATE / "lock"
+FILE_RELOAD = DIR_STATE / "reload.json"
+
+NAME_WORKER = "external-commands-worker"
+FILE_SOCKET = Path("/run/external_commands/worker.sock")
+FILE_UNIT = Path(f"/etc/systemd/system/{NAME_WORKER}.service")
+
 MODULES_LIBRARY = { "toml", "pyzipper", "lxml", "html5lib", "dnspython", "beautifulsoup4", "faust-cchardet" }
 
-TEMPLATE_PIP = Template("$interpreter -m pip install --upgrade $modules $$($interpreter -m pip list 2> /dev/null | tail -n +3 | cut -d ' ' -f1)")
+SCRIPT_DISTRIBUTIONS = "import json, importlib.metadata; print(json.dumps([ (distribution.metadata['Name'], distribution.version) for distribution in importlib.metadata.distributions() ]))"
+
+REGEX_REQUIREMENT = compile_regex(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?\s*(?:(==|>=|<=|!=|~=|>|<)\s*([A-Za-z0-9.*+!_-]+))?\s*$")
+REGEX_NORMALIZE = compile_regex(r"[-_.]+")
+REGEX_SCRIPT_VERSION = compile_regex(r"^#\s*\S+\.py\s+V([0-9][0-9A-Za-z.+-]*)\s*$")
+REGEX_RELEASE = compile_regex(r"^(?:[0-9]+!)?([0-9]+(?:\.[0-9]+)*)")
 
 TEMPLATE_LIST_ADDRESS = Template('<?xml version="1.0" encoding="UTF-8" standalone="no"?><AddressList name=$name type="static" uuid="$uuid">$items</AddressList>')
 TEMPLATE_ADDRESS = Template("<Address>$item</Address>")
@@ -63,23 +145,326 @@ TEMPLATE_LIST_URL = Template('<?xml version="1.0" encoding="UTF-8" standalone="n
 TEMPLATE_URL = Template("<Url>$item</Url>")
 TEMPLATE_LIST_LEXICAL = Template('<?xml version="1.0" encoding="UTF-8" standalone="no"?><TextualAnalysis count="$count" followedby="10" name=$name nearness="10" summary="" threshold="10" triggerOnce="false" uuid="$uuid">$items</TextualAnalysis>')
 TEMPLATE_PHRASE = Template('<Phrase case="false" redact="false" summary="" text=$item type="custom" uuid="$uuid" weight="10"><customEntityIndexes/><qualifierIndexes/></Phrase>')
-TEMPLATE_AREA = Template('<MessageArea auditorNotificationAuditor="admin" auditorNotificationAuditorAddress="" auditorNotificationEnabled="false" auditorNotificationpwdOtherAddress="" auditorNotificationPlainBody="A message was released by %RELEASEDBY% which violated the policy %POLICYVIOLATED%. A version of the email has been attached.&#10;&#10;To: %RCPTS%&#10;Subject: %SUBJECT%&#10;Date sent: %DATE%" auditorNotificationSender="admin" auditorNotificationSubject="A message which violated policy %POLICYVIOLATED% has been released." delayedReleaseDelay="15" expiry="30" name=$name notificationEnabled="false" notificationOtherAddress="" notificationPlainBody="A message you sent has been released by the administrator&#10;&#10;To: %RCPTS%&#10;Subject: %SUBJECT%&#10;Date sent: %DATE%" notificationSender="admin" notificationSubject="A message you sent has been released" notspam="true" pmm="false" releaseRate="10000" releaseScheduleType="throttle" scheduleEnabled="false" system="false" uuid="$uuid"><PMMAddressList/><WeeklySchedule mode="ONE_HOUR"><DailyScheduleList><DailySchedule day="1" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="2" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="3" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="4" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="5" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="6" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="7" mode="ONE_HOUR">000000000000000000000000</DailySchedule></DailyScheduleList></WeeklySchedule></MessageArea></DisposalCollection>')
+TEMPLATE_AREA = Template('<MessageArea auditorNotificationAuditor="admin" auditorNotificationAuditorAddress="" auditorNotificationEnabled="false" auditorNotificationpwdOtherAddress="" auditorNotificationPlainBody="A message was released by %RELEASEDBY% which violated the policy %POLICYVIOLATED%. A version of the email has been attached.&#10;&#10;To: %RCPTS%&#10;Subject: %SUBJECT%&#10;Date sent: %DATE%" auditorNotificationSender="admin" auditorNotificationSubject="A message which violated policy %POLICYVIOLATED% has been released." delayedReleaseDelay="15" expiry="30" name=$name notificationEnabled="false" notificationOtherAddress="" notificationPlainBody="A message you sent has been released by the administrator&#10;&#10;To: %RCPTS%&#10;Subject: %SUBJECT%&#10;Date sent: %DATE%" notificationSender="admin" notificationSubject="A message you sent has been released" notspam="true" pmm="false" releaseRate="10000" releaseScheduleType="throttle" scheduleEnabled="false" system="false" uuid="$uuid"><PMMAddressList/><WeeklySchedule mode="ONE_HOUR"><DailyScheduleList><DailySchedule day="1" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="2" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="3" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="4" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="5" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="6" mode="ONE_HOUR">000000000000000000000000</DailySchedule><DailySchedule day="7" mode="ONE_HOUR">000000000000000000000000</DailySchedule></DailyScheduleList></WeeklySchedule></MessageArea>')
 TEMPLATE_RULE = Template('<?xml version="1.0" encoding="UTF-8" standalone="no"?><ExecutablePolicyRule name=$name siteSpecific="false" template="9255cf2d-3000-832b-406e-38bd46975444" uuid="$uuid_rule"><WhatToFind><MediaTypes selection="anyof" uuid="$uuid_media">$media_types</MediaTypes><Direction direction="either" uuid="$uuid_direction"/><ExecutableSettings uuid="$uuid_command"><Filename>$command</Filename><CmdLine>$parameters</CmdLine><ResponseList>$responses</ResponseList><Advanced mutex="false" timeout="$timeout"><LogFilePrefix>&gt;&gt;&gt;&gt;</LogFilePrefix><LogFilePostfix>&lt;&lt;&lt;&lt;</LogFilePostfix></Advanced></ExecutableSettings></WhatToFind><PrimaryActions><WhatToDo><Disposal disposal="$uuid_deliver" primaryCrypto="UNDEFINED" secondary="$uuid_none" secondaryCrypto="UNDEFINED" uuid="$uuid_deliver_action"/></WhatToDo><WhatToDoWeb><PrimaryWebAction editable="true" type="allow" uuid="$uuid_deliver_web"/></WhatToDoWeb><WhatElseToDo/></PrimaryActions><ModifiedActions><WhatToDo><Disposal disposal="$uuid_modified_primary" primaryCrypto="UNDEFINED" secondary="$uuid_modified_secondary" secondaryCrypto="UNDEFINED" uuid="$uuid_modified_action"/></WhatToDo><WhatToDoWeb><PrimaryWebAction editable="true" type="none" uuid="$uuid_modified_web"/></WhatToDoWeb><WhatElseToDo/></ModifiedActions><DetectedActions><WhatToDo><Disposal disposal="$uuid_detected_primary" primaryCrypto="UNDEFINED" secondary="$uuid_detected_secondary" secondaryCrypto="UNDEFINED" uuid="$uuid_detected_action"/></WhatToDo><WhatToDoWeb><PrimaryWebAction editable="true" type="none" uuid="$uuid_detected_web"/></WhatToDoWeb><WhatElseToDo/></DetectedActions></ExecutablePolicyRule>')
 TEMPLATE_MEDIA = Template('<MediaType$sub_types>$uuid</MediaType>')
 TEMPLATE_RESPONSE = Template('<Response action="$action" code="$return_code">$description</Response>')
 TEMPLATE_PARAMETER = Template("# $name\n# type: $type\n# description: $description\n\n$name = $value")
+TEMPLATE_CLIENT = Template('''# command_client.py - forward external command run to resident worker (generated by external_commands.py)
+
+import sys, os, socket, struct, json, signal, syslog
+
+SOCKET = $socket
+INTERPRETER = $interpreter
+COMMAND = $command
+
+try:
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(SOCKET)
+except (FileNotFoundError, ConnectionRefusedError):
+    # worker not running, run external command script directly
+    os.execv(INTERPRETER, [ INTERPRETER, COMMAND ] + sys.argv[1:])
+except OSError as ex:
+    # worker running but not usable (e.g. run as another user), report misconfiguration and run external command script directly
+    syslog.syslog(syslog.LOG_ERR, f"command_client.py: cannot connect to resident worker: {ex}")
+
+    os.execv(INTERPRETER, [ INTERPRETER, COMMAND ] + sys.argv[1:])
+
+request = json.dumps({ "argv": sys.argv[1:], "cwd": os.getcwd(), "environ": dict(os.environ) }).encode()
+
+try:
+    socket.send_fds(connection, [ struct.pack("!I", len(request)) ], [ 0, 1, 2 ])
+    connection.sendall(request)
+
+    response = b""
+
+    while len(response) < 4:
+        data = connection.recv(4 - len(response))
+
+        if not data:
+            break
+
+        response += data
+except OSError:
+    response = b""
+
+if len(response) != 4:
+    sys.exit($return_code_error)
+
+code = struct.unpack("!i", response)[0]
+
+if code < 0:
+    # external command script was killed by signal, die the same way
+    signal.signal(-code, signal.SIG_DFL)
+    os.kill(os.getpid(), -code)
+
+sys.exit(code)
+''')
+TEMPLATE_SERVER = Template('''# command_server.py - resident worker for external commands (generated by external_commands.py)
+#
+# Python modules are imported once, every request is run by a forked child with the file descriptors, arguments,
+# working directory and environment of the client. The child runs in its own process group, which is killed if the
+# client goes away (e.g. killed by Clearswift on rule timeout).
+#
+# The library and the external command scripts written to the script directory are loaded once from their hash-checked
+# bytecode (and again when the files change). Instead of the external command script extracting and compiling library
+# and script from the lexical lists, the child executes the pre-compiled script of the requested external command list
+# as __main__ with the names of the pre-imported library. Requests for other lists run the external command script.
+
+import sys, os, socket, struct, json, runpy, traceback, atexit, signal, select, re
+from importlib import import_module, reload
+from importlib.machinery import SourceFileLoader
+from importlib.metadata import packages_distributions
+
+CONFIG = $config
+
+def normalize(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def preload(set_distribution):
+    for (module, list_distribution) in packages_distributions().items():
+        if not module.startswith("_") and any(normalize(distribution) in set_distribution for distribution in list_distribution):
+            try:
+                import_module(module)
+            except Exception:
+                pass
+
+def get_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+def load(config, library=None):
+    dict_key = { path: get_key(path) for path in [ config["library"], *config["commands"].values() ] }
+
+    try:
+        library = import_module(os.path.basename(config["library"])[:-3]) if library is None else reload(library)
+    except Exception:
+        return (dict_key, None, dict())
+
+    dict_code = dict()
+
+    for (name_list, path) in config["commands"].items():
+        name = os.path.basename(path)[:-3]
+
+        try:
+            dict_code[name_list] = (path, SourceFileLoader(name, path).get_code(name))
+        except Exception:
+            pass
+
+    return (dict_key, library, dict_code)
+
+def receive(connection, size):
+    data = b""
+
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+
+        if not chunk:
+            raise EOFError("Connection closed")
+
+        data += chunk
+
+    return data
+
+def run(list_fd, request, command, library, dict_code):
+    for (fd_target, fd) in enumerate(list_fd):
+        os.dup2(fd, fd_target)
+        os.close(fd)
+
+    os.chdir(request["cwd"])
+
+    os.environ.clear()
+    os.environ.update(request["environ"])
+
+    sys.stdin = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", closefd=False)
+    sys.stderr = open(2, "w", errors="backslashreplace", buffering=1, closefd=False)
+    sys.argv = [ command ] + request["argv"]
+
+    if library is not None and request["argv"] and request["argv"][-1] in dict_code:
+        (path, code_script) = dict_code[request["argv"][-1]]
+    else:
+        (path, code_script) = (command, None)
+
+    try:
+        if code_script is None:
+            runpy.run_path(command, run_name="__main__")
+        else:
+            namespace = { name: value for (name, value) in vars(library).items() if not name.startswith("__") }
+            namespace.update(__name__="__main__", __file__=path, __builtins__=__builtins__)
+
+            exec(code_script, namespace)
+
+        code = 0
+    except SystemExit as ex:
+        if ex.code is None:
+            code = 0
+        elif isinstance(ex.code, int):
+            code = ex.code
+        else:
+            print(ex.code, file=sys.stderr)
+
+            code = 1
+    except BaseException as ex:
+        # report like the interpreter, without the frames of the worker
+        tb = ex.__traceback__
+
+        while tb is not None and tb.tb_frame.f_code.co_filename != path:
+            tb = tb.tb_next
+
+        traceback.print_exception(type(ex), ex, tb)
+
+        code = 1
+
+    atexit._run_exitfuncs()
 
-TupleInfo = namedtuple("TupleInfo", "directory tag template_list template_item process_item")
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    return code
+
+def handle(connection, command, library, dict_code):
+    (header, list_fd, _, _) = socket.recv_fds(connection, 4, 3)
+
+    request = json.loads(receive(connection, struct.unpack("!I", header + receive(connection, 4 - len(header)))[0]))
+
+    # SIGCHLD wakes up the poll below
+    (fd_wakeup, fd_signal) = os.pipe()
+
+    os.set_blocking(fd_signal, False)
+
+    signal.set_wakeup_fd(fd_signal)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    pid = os.fork()
+
+    if pid == 0:
+        code = $return_code_error
+
+        try:
+            os.setpgid(0, 0)
+
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+            connection.close()
+            os.close(fd_wakeup)
+            os.close(fd_signal)
+
+            code = run(list_fd, request, command, library, dict_code)
+        finally:
+            os._exit(code & 0xff)
+
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+
+    for fd in list_fd:
+        os.close(fd)
+
+    poll = select.poll()
+    poll.register(connection, select.POLLIN)
+    poll.register(fd_wakeup, select.POLLIN)
+
+    while True:
+        (pid_done, status) = os.waitpid(pid, os.WNOHANG)
+
+        if pid_done:
+            return os.waitstatus_to_exitcode(status)
+
+        for (fd, _) in poll.poll():
+            if fd == fd_wakeup:
+                os.read(fd_wakeup, 512)
+            else:
+                # client sends nothing after the request, so the connection only becomes readable when closed
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+                os.waitpid(pid, 0)
+
+                return None
+
+def main():
+    with open(CONFIG, "r") as f:
+        config = json.load(f)
+
+    sys.path[0] = os.path.dirname(config["command"])
+
+    preload({ normalize(module) for module in config["modules"] })
+
+    (dict_key, library, dict_code) = load(config)
+
+    try:
+        os.unlink(config["socket"])
+    except FileNotFoundError:
+        pass
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(config["socket"])
+    os.chmod(config["socket"], 0o660)
+    server.listen(128)
+
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    while True:
+        (connection, _) = server.accept()
+
+        if any(get_key(path) != key for (path, key) in dict_key.items()):
+            (dict_key, library, dict_code) = load(config, library)
+
+        if os.fork() == 0:
+            server.close()
+
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+            try:
+                code = handle(connection, config["command"], library, dict_code)
+            except BaseException:
+                code = $return_code_error
+
+            try:
+                if code is not None:
+                    connection.sendall(struct.pack("!i", code))
+            finally:
+                os._exit(0)
+
+        connection.close()
+
+main()
+''')
+TEMPLATE_UNIT = Template("""[Unit]
+Description=Resident worker for Clearswift external commands
+After=network.target
+
+[Service]
+User=$user
+RuntimeDirectory=$runtime
+ExecStart=$interpreter $server
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+""")
+
+TupleInfo = namedtuple("TupleInfo", "directory tag tag_item template_list template_item process_item")
 
 LIST_INFO = {
-    "address": TupleInfo(directory=DIR_ADDRESS, tag="AddressList", template_list=TEMPLATE_LIST_ADDRESS, template_item=TEMPLATE_ADDRESS, process_item=escape),
-    "filename": TupleInfo(directory=DIR_FILENAME, tag="FilenameList", template_list=TEMPLATE_LIST_FILENAME, template_item=TEMPLATE_FILENAME, process_item=escape),
-    "url": TupleInfo(directory=DIR_URL, tag="UrlList", template_list=TEMPLATE_LIST_URL, template_item=TEMPLATE_URL, process_item=escape),
-    "lexical": TupleInfo(directory=DIR_LEXICAL, tag="TextualAnalysis", template_list=TEMPLATE_LIST_LEXICAL, template_item=TEMPLATE_PHRASE, process_item=quoteattr)
+    "address": TupleInfo(directory=DIR_ADDRESS, tag="AddressList", tag_item="Address", template_list=TEMPLATE_LIST_ADDRESS, template_item=TEMPLATE_ADDRESS, process_item=escape),
+    "filename": TupleInfo(directory=DIR_FILENAME, tag="FilenameList", tag_item="Filename", template_list=TEMPLATE_LIST_FILENAME, template_item=TEMPLATE_FILENAME, process_item=escape),
+    "url": TupleInfo(directory=DIR_URL, tag="UrlList", tag_item="Url", template_list=TEMPLATE_LIST_URL, template_item=TEMPLATE_URL, process_item=escape),
+    "lexical": TupleInfo(directory=DIR_LEXICAL, tag="TextualAnalysis", tag_item="Phrase", template_list=TEMPLATE_LIST_LEXICAL, template_item=TEMPLATE_PHRASE, process_item=quoteattr)
 }
 
 CS_USER = "tomcat"
 CS_GROUP = "cs-adm"
+CS_COMMAND_USER = "gw-services"
 
 KEY_PACKAGES = "packages"
 KEY_MODULES = "modules"
@@ -150,6 +535,13 @@ TupleAction = namedtuple("TupleAction", "primary secondary")
 TupleDisposalAction = namedtuple("TupleDisposalAction", "detected modified")
 TupleParameter = namedtuple("TupleParameter", "type description value")
 TupleRule = namedtuple("TupleRule", "packages modules list_address list_filename list_url list_lexical parameters timeout media_types responses disposal_actions config")
+TupleIndexEntry = namedtuple("TupleIndexEntry", "mtime size inode name uuid")
+TupleGateway = namedtuple("TupleGateway", "root directories file_disposal file_mediatypes file_status file_apply file_lock file_reload user group")
+TupleArtifacts = namedtuple("TupleArtifacts", "command library scripts configs")
+TupleSpan = namedtuple("TupleSpan", "name depth start duration")
+TupleList = namedtuple("TupleList", "type name items replace")
+TuplePlan = namedtuple("TuplePlan", "artifacts configs lists packages modules")
+TupleChange = namedtuple("TupleChange", "root operation target size count")
 
 @unique
 class ReturnCode(IntEnum):
@@ -196,7 +588,7 @@ class SAXExceptionFinished(SAXException):
 
 class HandlerName(handler.ContentHandler):
     """
-    Custom content handler for xml.sax for extracting name attribute for defined tag.
+    Custom content handler for xml.sax for extracting name and uuid attributes for defined tag.
     """
     def __init__(self, tag):
         """
@@ -204,12 +596,14 @@ class HandlerName(handler.ContentHandler):
         """
         self.tag = tag
         self.name = None
+        self.uuid = None
 
         super().__init__()
 
     def startElement(self, name, attrs):
         if name == self.tag and "name" in attrs:
             self.name = attrs["name"]
+            self.uuid = attrs.get("uuid")
 
             raise SAXExceptionFinished
 
@@ -221,6 +615,14 @@ class HandlerName(handler.ContentHandler):
         """
         return self.name
 
+    def getUUID(self):
+        """
+        Return uuid.
+
+        :rtype: str
+        """
+        return self.uuid
+
 class HandlerMediaTypes(handler.ContentHandler):
     """
     Custom content handler for xml.sax for extracting media types.
@@ -311,633 +713,3495 @@ class HandlerDisposalActions(handler.ContentHandler):
         """
         return self.dict_disposal_action
 
+class HandlerItems(handler.ContentHandler):
+    """
+    Custom content handler for xml.sax for extracting items and their uuids of CS list (text attribute for phrases of lexical expression lists, element text otherwise).
+    """
+    def __init__(self, tag):
+        """
+        :type tag: str
+        """
+        self.tag = tag
+        self.list_item = list()
+        self.list_text = None
+
+        super().__init__()
+
+    def startElement(self, name, attrs):
+        if name == self.tag:
+            if "text" in attrs:
+                self.list_item.append((attrs["text"], attrs.get("uuid")))
+            else:
+                self.list_text = list()
+
+    def characters(self, content):
+        if self.list_text is not None:
+            self.list_text.append(content)
+
+    def endElement(self, name):
+        if name == self.tag and self.list_text is not None:
+            self.list_item.append(("".join(self.list_text), None))
+
+            self.list_text = None
+
+    def getItems(self):
+        """
+        Return list of items and uuids.
+
+        :rtype: list
+        """
+        return self.list_item
+
 def eprint(*args, **kwargs):
     """
     Print to stderr.
     """
     print(*args, file=stderr, **kwargs)
 
-def get_commands():
+def write_atomic(file_target, content, mode=None, user=None, group=None, text=False):
     """
-    Download readme file from repo and extract external command info.
+    Write file by replacing it with a temporary file in the same directory, optionally setting mode and owner. Content is either bytes (str with text) or a function writing to the opened temporary file and returning whether it should replace the file. The temporary file is removed on errors, which are raised.
 
-    :rtype: dict
-    """
-    try:
-        readme = urlopen(URL_README).read().decode()
-    except Exception:
-        raise Exception(f"Cannot download readme file '{URL_README}'")
+    Return whether file has been replaced.
 
-    list_readme = readme.split("\n")
+    :type file_target: Path
+    :type content: bytes or str or function
+    :type mode: int
+    :type user: str or int
+    :type group: str or int
+    :type text: bool
+    :rtype: bool
+    """
+    file_tmp = file_target.with_name(f".{file_target.name}.{getpid()}.{get_ident()}")
 
-    dict_command = dict()
+    try:
+        with open(file_tmp, "w" if text else "wb", buffering=SIZE_BUFFER) as f:
+            if callable(content):
+                replace = content(f)
+            else:
+                f.write(content)
 
-    found = False
+                replace = True
 
-    for line in list_readme:
-        if line == "## External commands":
-            found = True
-        elif found:
-            if not line:
-                break
+        if replace:
+            if mode is not None:
+                chmod(file_tmp, mode)
 
-            split_line = line[2:].split(": ")
+            if user is not None:
+                chown(file_tmp, user=user, group=group)
 
-            if len(split_line) != 2:
-                raise Exception("Invalid external command line in readme")
+            file_tmp.replace(file_target)
+        else:
+            file_tmp.unlink()
+    except BaseException:
+        try:
+            file_tmp.unlink()
+        except Exception:
+            pass
 
-            command = split_line[0]
+        raise
 
-            if command in dict_command:
-                raise Exception(f"Duplicate command '{command}'")
+    return replace
 
-            dict_command[command] = split_line[1]
+def get_rooted(root, path):
+    """
+    Return absolute path below root directory.
 
-    return dict_command
+    :type root: Path
+    :type path: Path
+    :rtype: Path
+    """
+    return root / path.absolute().relative_to("/")
 
-def get_names(directory, tag):
+def get_gateway(root=DEFAULT_ROOT, user=CS_USER, group=CS_GROUP):
     """
-    Get names of Clearswift item lists.
+    Get Clearswift gateway configuration paths under root directory and owner of written files.
 
-    :type directory: Path
-    :type tag: str
-    :rtype: set
+    :type root: Path
+    :type user: str
+    :type group: str
+    :rtype: TupleGateway
     """
-    handler = HandlerName(tag)
+    rooted = lambda path: get_rooted(root, path)
+
+    directories = { type_list: rooted(info.directory) for (type_list, info) in LIST_INFO.items() }
+    directories[TYPE_RULE] = rooted(DIR_RULES)
+
+    return TupleGateway(
+        root=root,
+        directories=directories,
+        file_disposal=rooted(FILE_DISPOSAL),
+        file_mediatypes=rooted(FILE_MEDIATYPES),
+        file_status=rooted(FILE_STATUS),
+        file_apply=rooted(FILE_APPLY),
+        file_lock=rooted(FILE_LOCK),
+        file_reload=rooted(FILE_RELOAD),
+        user=user,
+        group=group
+    )
+
+class Timings:
+    """
+    Record wall time spans of the phases of a run. Spans can be nested and are reported in the order they were started. Recording is a no-op unless enabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.start = None
+        self.local = local()
+        self.lock = Lock()
+        self.list_span = list()
 
-    parser = make_parser()
-    parser.setContentHandler(handler)
+    def enable(self):
+        """
+        Enable recording of spans.
+        """
+        self.enabled = True
+        self.start = perf_counter()
 
-    set_names = set()
+    @contextmanager
+    def span(self, name):
+        """
+        Record wall time of the enclosed block as span.
 
-    for entry in directory.iterdir():
-        if entry.is_file() and entry.suffix == ".xml":
-            try:
-                parser.parse(str(entry))
-            except SAXExceptionFinished:
-                pass
+        :type name: str
+        :rtype: generator
+        """
+        if not self.enabled:
+            yield
 
-            name = handler.getName()
+            return
 
-            if name is not None:
-                set_names.add(name)
+        # reserve position so spans are listed in start order
+        with self.lock:
+            index = len(self.list_span)
 
-    return set_names
+            self.list_span.append(None)
 
-def get_media_types():
-    """
-    Get Clearswift media type info.
+        # spans are nested per thread (gateway roots are processed concurrently)
+        depth = getattr(self.local, "depth", 0)
 
-    :rtype: dict
-    """
-    handler = HandlerMediaTypes()
+        self.local.depth = depth + 1
 
-    parser = make_parser()
-    parser.setContentHandler(handler)
+        start = perf_counter()
 
-    try:
-        parser.parse(str(FILE_MEDIATYPES))
-    except SAXExceptionFinished:
-        pass
+        try:
+            yield
+        finally:
+            self.local.depth = depth
 
-    return handler.getMediaTypes()
+            self.list_span[index] = TupleSpan(name=name, depth=depth, start=start - self.start, duration=perf_counter() - start)
 
-def get_disposal_actions():
-    """
-    Get Clearswift disposal actions info.
+    def summary(self, output_format):
+        """
+        Return summary of recorded spans as table or JSON.
 
-    :rtype: dict
-    """
-    handler = HandlerDisposalActions()
+        :type output_format: str
+        :rtype: str
+        """
+        total = perf_counter() - self.start
 
-    parser = make_parser()
-    parser.setContentHandler(handler)
+        if output_format == FORMAT_JSON:
+            return dumps({ "total": total, "spans": [ span._asdict() for span in self.list_span if span is not None ] }, indent=4)
 
-    try:
-        parser.parse(str(FILE_DISPOSAL))
-    except SAXExceptionFinished:
-        pass
+        list_line = [ f"{span.duration:10.3f}s  {'  ' * span.depth}{span.name}" for span in self.list_span if span is not None ]
 
-    return handler.getDisposalActions()
+        list_line.append(f"{total:10.3f}s  total")
 
-def create_list(type_list, name_list, list_item, replace=True):
-    """
-    Create/replace CS list.
+        return "\n".join(list_line)
 
-    :type type_list: str
-    :type name_list: str
-    :type list_item: list
-    :type replace: bool
+TIMINGS = Timings()
+
+class ChangePlan:
     """
-    info = LIST_INFO[type_list]
+    Record changes of a dry run instead of making them, each with its expected size in bytes (None if not known in advance) and number of operations. Recording is a no-op unless enabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.local = local()
+        self.lock = Lock()
+        self.list_change = list()
+        self.configuration = False
+
+    def enable(self):
+        """
+        Enable dry run.
+        """
+        self.enabled = True
 
-    handler = HandlerName(info.tag)
+    @contextmanager
+    def scope(self, root):
+        """
+        Record changes made in the enclosed block for gateway root (gateway roots are processed concurrently).
 
-    parser = make_parser()
-    parser.setContentHandler(handler)
+        :type root: Path
+        :rtype: generator
+        """
+        self.local.root = root
 
-    for entry in info.directory.iterdir():
-        if entry.is_file() and entry.suffix == ".xml":
-            try:
-                parser.parse(str(entry))
-            except SAXExceptionFinished:
-                pass
+        try:
+            yield
+        finally:
+            self.local.root = None
 
-            name = handler.getName()
+    def add(self, operation, target, size=0, count=1):
+        """
+        Record change.
 
-            if name == name_list:
-                if replace:
-                    uuid = entry.stem
-                    file_list = info.directory / f"{uuid}.xml"
+        :type operation: str
+        :type target: str or Path
+        :type size: int
+        :type count: int
+        """
+        if not self.enabled:
+            return
 
-                    break
-                else:
-                    return
-    else:
-        while True:
-            uuid = generate_uuid()
-            file_list = info.directory / f"{uuid}.xml"
+        root = getattr(self.local, "root", None)
 
-            if not file_list.exists():
-                break
+        with self.lock:
+            self.list_change.append(TupleChange(root=None if root is None else str(root), operation=operation, target=str(target), size=size, count=count))
 
-    try:
-        with open(file_list, "w") as f:
-            f.write(info.template_list.substitute(name=quoteattr(name_list), uuid=uuid, count=len(list_item), items="".join([ info.template_item.substitute(item=info.process_item(item), uuid=generate_uuid()) for item in list_item ])))
+    def summary(self, output_format):
+        """
+        Return summary of recorded changes grouped by gateway root (changes on the host running the script first) as table or JSON.
 
-        chown(file_list, user=CS_USER, group=CS_GROUP)
-    except Exception:
-        raise Exception(f"Cannot write list file '{file_list}'")
+        :type output_format: str
+        :rtype: str
+        """
+        list_change = sorted(self.list_change, key=lambda change: (change.root is not None, change.root or ""))
 
-def list2set(list_in):
-    """
-    Create set from list and check for duplicate items.
+        size = sum(change.size for change in list_change if change.size is not None)
+        count = sum(change.count for change in list_change)
 
-    :type list_in: list
-    :rtype: set
-    """
-    if list_in is None:
-        return None
+        if output_format == FORMAT_JSON:
+            return dumps({ "changes": [ change._asdict() for change in list_change ], "size": size, "count": count, "apply": self.configuration }, indent=4)
 
-    set_out = set(list_in)
+        list_line = list()
 
-    if len(set_out) < len(list_in):
-        raise Exception(f"Duplicate list items {str({ item for (item, count) in Counter(list_in).items() if count > 1 })[1:-1]}")
+        root = False
 
-    return set_out
+        for change in list_change:
+            if change.root != root:
+                root = change.root
 
-def parse_config(command, configuration):
+                list_line.append("host" if root is None else root)
+
+            list_line.append(f"{'?' if change.size is None else change.size:>12}  {change.count:>5}  {change.operation} - {change.target}")
+
+        list_line.append(f"{size:>12}  {count:>5}  total")
+        list_line.append(f"Configuration apply {'needed' if self.configuration else 'not needed'}")
+
+        return "\n".join(list_line)
+
+CHANGES = ChangePlan()
+
+class TaskGraph:
     """
-    Parse external command config.
+    Run tasks with explicit dependencies concurrently in a thread pool, each task as soon as all of its dependencies have finished.
+
+    Ready tasks are started in the order they were added. After the first error no further tasks are started, the running ones are waited for and the error is raised.
+    """
+    def __init__(self):
+        self.dict_task = dict()
+
+    def add(self, name, function, depends=()):
+        """
+        Add task. Dependencies have to be added before. The function is called with the dict of results of finished tasks.
+
+        :type name: str
+        :type function: function
+        :type depends: iterable
+        """
+        if name in self.dict_task:
+            raise Exception(f"Duplicate task '{name}'")
+
+        set_depend = set(depends)
+
+        unknown = set_depend - self.dict_task.keys()
+
+        if unknown:
+            raise Exception(f"Unknown dependencies {str(unknown)[1:-1]} of task '{name}'")
+
+        self.dict_task[name] = (function, set_depend)
+
+    def run(self):
+        """
+        Run all tasks and return dict of their results.
+
+        :rtype: dict
+        """
+        dict_result = dict()
+        dict_pending = dict(self.dict_task)
+        dict_running = dict()
+        dict_order = { name: order for (order, name) in enumerate(self.dict_task.keys()) }
+
+        error = None
+
+        def run_task(name, function):
+            with TIMINGS.span(name):
+                return function(dict_result)
+
+        with ThreadPoolExecutor(max_workers=max(len(self.dict_task), 1)) as executor:
+            while True:
+                if error is None:
+                    for (name, (function, set_depend)) in list(dict_pending.items()):
+                        if set_depend <= dict_result.keys():
+                            del dict_pending[name]
+
+                            dict_running[executor.submit(run_task, name, function)] = name
+
+                if not dict_running:
+                    break
+
+                (set_done, _) = wait(dict_running.keys(), return_when=FIRST_COMPLETED)
+
+                for future in sorted(set_done, key=lambda future: dict_order[dict_running[future]]):
+                    name = dict_running.pop(future)
+
+                    try:
+                        dict_result[name] = future.result()
+                    except Exception as ex:
+                        if error is None:
+                            error = ex
+
+        if error is not None:
+            raise error
+
+        return dict_result
+
+class Downloader:
+    """
+    Download files from repo concurrently over a small pool of persistent HTTP(S) connections, with retry and timeout per file.
+
+    The repo can be a URL or a local directory/file:// mirror. With a cache directory, downloaded files are stored with their ETag/Last-Modified and revalidated with conditional requests. With a dict of hashes, the content hash of each downloaded file is recorded with its ETag/Last-Modified, so it can later be confirmed without downloading the file.
+    """
+    def __init__(self, repo=URL_REPO, cache=None, connections=DEFAULT_CONNECTIONS, retries=DOWNLOAD_RETRIES, timeout=DOWNLOAD_TIMEOUT, hashes=None):
+        """
+        :type repo: str
+        :type cache: Path
+        :type connections: int
+        :type retries: int
+        :type timeout: int
+        :type hashes: dict
+        """
+        if not urlsplit(repo).scheme:
+            repo = Path(repo).resolve().as_uri()
+
+        self.repo = repo.rstrip("/")
+        self.cache = cache
+        self.connections = connections
+        self.retries = retries
+        self.timeout = timeout
+        self.hashes = hashes
+        self.hashes_changed = False
+        self.dict_pool = dict()
+        self.dict_fetched = dict()
+
+    def get_url(self, path):
+        """
+        Return URL of file in repo.
+
+        :type path: str
+        :rtype: str
+        """
+        return f"{self.repo}/{path}"
+
+    def get_pool(self, scheme, netloc):
+        """
+        Return pool of idle connections for host.
+
+        :type scheme: str
+        :type netloc: str
+        :rtype: SimpleQueue
+        """
+        return self.dict_pool.setdefault((scheme, netloc), SimpleQueue())
+
+    def request(self, url, headers):
+        """
+        Send GET request over pooled connection, following redirects. Return status code, response headers and body.
+
+        :type url: str
+        :type headers: dict
+        :rtype: tuple
+        """
+        for _ in range(DOWNLOAD_REDIRECTS):
+            split_url = urlsplit(url)
+
+            pool = self.get_pool(split_url.scheme, split_url.netloc)
+
+            try:
+                connection = pool.get_nowait()
+            except Empty:
+                if split_url.scheme == "https":
+                    connection = HTTPSConnection(split_url.netloc, timeout=self.timeout)
+                else:
+                    connection = HTTPConnection(split_url.netloc, timeout=self.timeout)
+
+            path = split_url.path or "/"
+
+            if split_url.query:
+                path = f"{path}?{split_url.query}"
+
+            try:
+                connection.request("GET", path, headers={ "Connection": "keep-alive", **headers })
+
+                response = connection.getresponse()
+
+                body = response.read()
+            except Exception:
+                connection.close()
+
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                pool.put(connection)
+
+            if response.status in { 301, 302, 303, 307, 308 } and response.getheader("Location"):
+                url = urljoin(url, response.getheader("Location"))
+            else:
+                return (response.status, response.headers, body)
+
+        raise Exception(f"Too many redirects for '{url}'")
+
+    def load_cache(self, url):
+        """
+        Return cached metadata and content for URL or None if not cached.
+
+        :type url: str
+        :rtype: tuple
+        """
+        if self.cache is None:
+            return None
+
+        file_cache = self.cache / sha256(url.encode()).hexdigest()
+
+        try:
+            with open(file_cache.with_suffix(".json"), "r") as f:
+                metadata = loads(f.read())
+
+            with open(file_cache, "rb") as f:
+                content = f.read()
+        except Exception:
+            return None
+
+        if metadata.get("url") != url or metadata.get("sha256") != sha256(content).hexdigest():
+            return None
+
+        return (metadata, content)
+
+    def store_cache(self, url, headers, content):
+        """
+        Store content for URL with its validators in cache. Content which cannot be stored is simply downloaded again next time, content of a dry run is not stored.
+
+        :type url: str
+        :type headers: http.client.HTTPMessage
+        :type content: bytes
+        """
+        if self.cache is None or CHANGES.enabled or (headers.get("ETag") is None and headers.get("Last-Modified") is None):
+            return
+
+        file_cache = self.cache / sha256(url.encode()).hexdigest()
+
+        try:
+            self.cache.mkdir(parents=True, exist_ok=True)
+
+            write_atomic(file_cache, content)
+            write_atomic(file_cache.with_suffix(".json"), dumps({ "url": url, "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified"), "sha256": sha256(content).hexdigest() }).encode())
+        except Exception:
+            pass
+
+    def store_hash(self, url, headers, content):
+        """
+        Record content hash of URL with its validators.
+
+        :type url: str
+        :type headers: dict
+        :type content: bytes
+        """
+        if self.hashes is None or (headers.get("ETag") is None and headers.get("Last-Modified") is None):
+            return
+
+        record = { "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified"), "sha256": hash_content(content) }
+
+        if self.hashes.get(url) != record:
+            self.hashes[url] = record
+            self.hashes_changed = True
+
+    def probe_hash(self, url):
+        """
+        Return content hash of file if the hash recorded for an earlier download is confirmed by a conditional request, so the file does not need to be downloaded. Content sent instead (file changed) is kept for downloading the file. Return None if the hash cannot be confirmed.
+
+        :type url: str
+        :rtype: str
+        """
+        record = None if self.hashes is None else self.hashes.get(url)
+
+        if record is None or urlsplit(url).scheme not in { "http", "https" }:
+            return None
+
+        headers = dict()
+
+        if record["etag"]:
+            headers["If-None-Match"] = record["etag"]
+
+        if record["last_modified"]:
+            headers["If-Modified-Since"] = record["last_modified"]
+
+        try:
+            (status, headers_response, body) = self.request(url, headers)
+        except Exception:
+            return None
+
+        if status == 304:
+            return record["sha256"]
+
+        if status != 200:
+            return None
+
+        self.store_cache(url, headers_response, body)
+        self.store_hash(url, headers_response, body)
+
+        self.dict_fetched[url] = body
+
+        return hash_content(body)
+
+    def download(self, url):
+        """
+        Download file, revalidating cached content and retrying on connection errors and server errors.
+
+        :type url: str
+        :rtype: bytes
+        """
+        if urlsplit(url).scheme not in { "http", "https" }:
+            with urlopen(url, timeout=self.timeout) as response:
+                return response.read()
+
+        if url in self.dict_fetched:
+            return self.dict_fetched.pop(url)
+
+        cached = self.load_cache(url)
+
+        headers = dict()
+
+        if cached is not None:
+            (metadata, content) = cached
+
+            if metadata.get("etag"):
+                headers["If-None-Match"] = metadata["etag"]
+
+            if metadata.get("last_modified"):
+                headers["If-Modified-Since"] = metadata["last_modified"]
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                sleep(0.5 * 2 ** (attempt - 1))
+
+            try:
+                (status, headers_response, body) = self.request(url, headers)
+            except Exception as ex:
+                error = ex
+
+                continue
+
+            if status == 304 and cached is not None:
+                self.store_hash(url, { "ETag": metadata.get("etag"), "Last-Modified": metadata.get("last_modified") }, content)
+
+                return content
+
+            if status == 200:
+                self.store_cache(url, headers_response, body)
+                self.store_hash(url, headers_response, body)
+
+                return body
+
+            error = Exception(f"HTTP status {status}")
+
+            if status < 500:
+                break
+
+        raise error
+
+    def download_all(self, dict_path):
+        """
+        Download files from repo concurrently. Takes a dict of paths relative to the repo and descriptions (used in error messages) and returns a dict of paths and contents.
+
+        :type dict_path: dict
+        :rtype: dict
+        """
+        def download(path):
+            url = self.get_url(path)
+
+            try:
+                return self.download(url)
+            except Exception:
+                raise Exception(f"Cannot download {dict_path[path]} '{url}'")
+
+        list_path = list(dict_path.keys())
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.connections, len(list_path)))) as executor:
+            return dict(zip(list_path, executor.map(download, list_path)))
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+        for pool in self.dict_pool.values():
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except Empty:
+                    break
+
+def parse_readme(readme):
+    """
+    Extract external command info from readme file.
+
+    :type readme: str
+    :rtype: dict
+    """
+    list_readme = readme.split("\n")
+
+    dict_command = dict()
+
+    found = False
+
+    for line in list_readme:
+        if line == "## External commands":
+            found = True
+        elif found:
+            if not line:
+                break
+
+            split_line = line[2:].split(": ")
+
+            if len(split_line) != 2:
+                raise Exception("Invalid external command line in readme")
+
+            command = split_line[0]
+
+            if command in dict_command:
+                raise Exception(f"Duplicate command '{command}'")
+
+            dict_command[command] = split_line[1]
+
+    return dict_command
+
+def parse_catalog(content):
+    """
+    Parse catalog manifest with description, version and content hashes of script, config and readme of external commands.
+
+    :type content: str
+    :rtype: dict
+    """
+    try:
+        manifest = loads(content)
+
+        catalog = { "files": { name_file: manifest.get("files", dict()).get(name_file) for name_file in (FILE_COMMAND, FILE_LIBRARY) }, "commands": dict() }
+
+        for (command, entry) in manifest["commands"].items():
+            if not isinstance(entry.get("description"), str):
+                raise Exception(f"Description missing for command '{command}'")
+
+            catalog["commands"][command] = { "description": entry["description"], "version": entry.get("version"), "hashes": entry.get("hashes", dict()) }
+    except Exception:
+        raise Exception("Invalid catalog")
+
+    return catalog
+
+def build_catalog(directory):
+    """
+    Build catalog manifest for local copy of external commands repo.
+
+    :type directory: Path
+    :rtype: dict
+    """
+    def read_file(path):
+        try:
+            with open(directory / path, "rb") as f:
+                return f.read()
+        except Exception:
+            raise Exception(f"Cannot read file '{directory / path}'")
+
+    try:
+        dict_command = parse_readme(read_file(FILE_README).decode())
+    except UnicodeDecodeError:
+        raise Exception("Readme file not valid UTF-8")
+
+    catalog = { "version": VERSION_CATALOG, "files": { name_file: hash_content(read_file(name_file)) for name_file in (FILE_COMMAND, FILE_LIBRARY) }, "commands": dict() }
+
+    for (command, description) in sorted(dict_command.items()):
+        script = read_file(get_path_script(command))
+
+        match = REGEX_SCRIPT_VERSION.match(script.split(b"\n", 1)[0].decode(errors="replace"))
+
+        catalog["commands"][command] = {
+            "description": description,
+            "version": None if match is None else match.group(1),
+            "hashes": { "script": hash_content(script), "config": hash_content(read_file(get_path_config(command))), "readme": hash_content(read_file(f"{command}/{FILE_README}")) }
+        }
+
+    return catalog
+
+def download_catalog(downloader, manifest=True):
+    """
+    Download catalog manifest from repo. Repos without manifest get a catalog derived from the readme file (without versions and hashes). Without manifest the manifest is not requested, as the repo is known to have none.
+
+    Return catalog and whether it has been read from the manifest.
+
+    :type downloader: Downloader
+    :type manifest: bool
+    :rtype: tuple
+    """
+    content = None
+
+    if manifest:
+        try:
+            content = downloader.download_all({ FILE_CATALOG: "catalog" })[FILE_CATALOG]
+        except Exception:
+            pass
+
+    if content is not None:
+        return (parse_catalog(content.decode(errors="replace")), True)
+
+    try:
+        readme = downloader.download_all({ FILE_README: "readme file" })[FILE_README].decode()
+    except UnicodeDecodeError:
+        raise Exception("Readme file not valid UTF-8")
+
+    return ({ "files": dict(), "commands": { command: { "description": description, "version": None, "hashes": dict() } for (command, description) in parse_readme(readme).items() } }, False)
+
+def get_catalog(downloader, refresh=True):
+    """
+    Get catalog of external commands. Without refresh the local copy of the catalog is used if available for the repo and downloaded within the check interval, an older local copy is only used if the catalog cannot be downloaded. A local copy which cannot be read or written is ignored and the catalog downloaded.
+
+    The local copy also records whether the repo has a catalog manifest, so repos without manifest are only asked for it again after the check interval.
+
+    :type downloader: Downloader
+    :type refresh: bool
+    :rtype: dict
+    """
+    manifest = True
+    time_downloaded = time_checked = time()
+    catalog_local = None
+
+    try:
+        with open(FILE_CATALOG_LOCAL, "r") as f:
+            catalog = loads(f.read())
+
+        if catalog["version"] == VERSION_CATALOG and catalog["repo"] == downloader.repo:
+            catalog_local = catalog["catalog"]
+
+            if not refresh and time_downloaded - catalog["downloaded"] < INTERVAL_CATALOG:
+                return catalog_local
+
+            if not catalog["manifest"] and time_checked - catalog["checked"] < INTERVAL_CATALOG:
+                manifest = False
+                time_checked = catalog["checked"]
+    except Exception:
+        pass
+
+    try:
+        (catalog, manifest) = download_catalog(downloader, manifest=manifest)
+    except Exception:
+        if refresh or catalog_local is None:
+            raise
+
+        return catalog_local
+
+    # local copy is not written in dry run
+    if CHANGES.enabled:
+        return catalog
+
+    try:
+        write_atomic(FILE_CATALOG_LOCAL, dumps({ "version": VERSION_CATALOG, "repo": downloader.repo, "manifest": manifest, "checked": time_checked, "downloaded": time_downloaded, "catalog": catalog }, separators=(",", ":")).encode())
+    except Exception:
+        pass
+
+    return catalog
+
+def load_hashes():
+    """
+    Load content hashes recorded for downloaded files. No hashes are returned if the hashes file is missing, unreadable or outdated.
+
+    :rtype: dict
+    """
+    try:
+        with open(FILE_HASHES, "r") as f:
+            hashes = loads(f.read())
+
+        if hashes["version"] == VERSION_HASHES:
+            return hashes["files"]
+    except Exception:
+        pass
+
+    return dict()
+
+def save_hashes(hashes):
+    """
+    Save content hashes recorded for downloaded files. Without saved hashes, repos without catalog manifest have their files downloaded on the next update. Nothing is saved in a dry run.
+
+    :type hashes: dict
+    """
+    if CHANGES.enabled:
+        return
+
+    try:
+        write_atomic(FILE_HASHES, dumps({ "version": VERSION_HASHES, "files": hashes }, separators=(",", ":")).encode())
+    except Exception:
+        pass
+
+def list_unchanged(policy_index, name_list, hash_catalog):
+    """
+    Check whether lexical expression list holding script consists of a single phrase matching the content hash.
+
+    :type policy_index: PolicyIndex
+    :type name_list: str
+    :type hash_catalog: str
+    :rtype: bool
+    """
+    file_list = policy_index.lookup("lexical", name_list)
+
+    if file_list is None:
+        return False
+
+    try:
+        list_item = get_items(file_list, LIST_INFO["lexical"])
+    except Exception:
+        return False
+
+    return len(list_item) == 1 and hash_content(list_item[0][0]) == hash_catalog
+
+def get_hashes(catalog, downloader, set_installed):
+    """
+    Return content hashes of external command script, library and installed external commands in the repo (None if not known). Hashes missing in the catalog (repos without manifest) are taken from earlier downloads if the repo confirms them with conditional requests.
+
+    :type catalog: dict
+    :type downloader: Downloader
+    :type set_installed: set
+    :rtype: dict
+    """
+    dict_hash = { name_file: catalog["files"].get(name_file) for name_file in (FILE_COMMAND, FILE_LIBRARY) }
+    dict_path = { FILE_COMMAND: FILE_COMMAND, FILE_LIBRARY: FILE_LIBRARY }
+
+    for command in set_installed:
+        dict_hash[command] = catalog["commands"].get(command, dict()).get("hashes", dict()).get("script")
+        dict_path[command] = get_path_script(command)
+
+    list_missing = [ name for (name, hash_file) in dict_hash.items() if hash_file is None ]
+
+    if list_missing:
+        with ThreadPoolExecutor(max_workers=max(1, min(downloader.connections, len(list_missing)))) as executor:
+            dict_hash.update(zip(list_missing, executor.map(lambda name: downloader.probe_hash(downloader.get_url(dict_path[name])), list_missing)))
+
+    return dict_hash
+
+def get_unchanged(dict_hash, list_location):
+    """
+    Return external command script, library and external commands which match the content hashes of the repo on all gateway roots, so they do not need to be downloaded. Files are compared with their copy in the script directory, library and external commands also with the lexical expression lists which remain the source of truth.
+
+    :type dict_hash: dict
+    :type list_location: list
+    :rtype: set
+    """
+    dict_path = { FILE_COMMAND: FILE_COMMAND, FILE_LIBRARY: FILE_LIBRARY }
+    dict_list = { FILE_LIBRARY: NAME_LIBRARY }
+
+    for name in dict_hash.keys() - { FILE_COMMAND, FILE_LIBRARY }:
+        dict_path[name] = f"{name}.py"
+        dict_list[name] = NAME_COMMAND.format(name)
+
+    set_unchanged = set()
+
+    for (name, hash_file) in dict_hash.items():
+        if hash_file is None:
+            continue
+
+        for (policy_index, directory) in list_location:
+            if name in dict_list and not list_unchanged(policy_index, dict_list[name], hash_file):
+                break
+
+            try:
+                with open(directory / dict_path[name], "rb") as f:
+                    if hash_content(f.read()) != hash_file:
+                        break
+            except Exception:
+                break
+        else:
+            set_unchanged.add(name)
+
+    return set_unchanged
+
+def parse_name(file_xml, tag):
+    """
+    Parse name and uuid of Clearswift item list or policy rule with xml.sax.
+
+    :type file_xml: Path
+    :type tag: str
+    :rtype: tuple
+    """
+    handler = HandlerName(tag)
+
+    parser = make_parser()
+    parser.setContentHandler(handler)
+
+    try:
+        parser.parse(str(file_xml))
+    except SAXExceptionFinished:
+        pass
+
+    return (handler.getName(), handler.getUUID())
+
+def unescape_attribute(value):
+    """
+    Normalize and unescape raw XML attribute value. Return None if the value contains references other than character references and predefined entities.
+
+    :type value: str
+    :rtype: str
+    """
+    value = value.replace("\r\n", "\n").replace("\t", " ").replace("\n", " ").replace("\r", " ")
+
+    if "&" not in value:
+        return value
+
+    if "&" in REGEX_REFERENCE.sub("", value):
+        return None
+
+    return REGEX_REFERENCE.sub(lambda match: chr(int(match[1])) if match[1] else chr(int(match[2], 16)) if match[2] else XML_ENTITY[match[3]], value)
+
+def sniff_name(file_xml, tag):
+    """
+    Extract name and uuid attributes of root element from the first bytes of Clearswift item list or policy rule. Return None if they cannot be determined that way.
+
+    :type file_xml: Path
+    :type tag: str
+    :rtype: tuple
+    """
+    with open(file_xml, "rb") as f:
+        head = f.read(SIZE_SNIFF)
+
+    if head.startswith(b"\xef\xbb\xbf"):
+        head = head[3:]
+
+    match = REGEX_ENCODING.match(head)
+
+    if match is not None and match[1].lower() not in { b"utf-8", b"utf8", b"us-ascii", b"ascii" }:
+        return None
+
+    match = REGEX_PROLOG.match(head)
+
+    if match is None:
+        return None
+
+    tag_root = tag.encode()
+
+    start = match.end()
+
+    if not head.startswith(tag_root, start):
+        return None
+
+    match = REGEX_ELEMENT.match(head, start + len(tag_root))
+
+    if match is None:
+        return None
+
+    element = match[1]
+
+    dict_attribute = dict()
+
+    for match in REGEX_ATTRIBUTE.finditer(element):
+        value = match[2] if match[2] is not None else match[3]
+
+        try:
+            value = unescape_attribute(value.decode())
+        except UnicodeDecodeError:
+            return None
+
+        if value is None:
+            return None
+
+        dict_attribute[match[1].decode()] = value
+
+    if "name" not in dict_attribute:
+        return None
+
+    return (dict_attribute["name"], dict_attribute.get("uuid"))
+
+def read_name(file_xml, tag):
+    """
+    Read name and uuid of Clearswift item list or policy rule, falling back to xml.sax if the root element cannot be sniffed from the start of the file.
+
+    :type file_xml: Path
+    :type tag: str
+    :rtype: tuple
+    """
+    result = sniff_name(file_xml, tag)
+
+    if result is None:
+        result = parse_name(file_xml, tag)
+
+    return result
+
+def load_index():
+    """
+    Load persistent name index. An empty index is returned if the index file is missing, unreadable or outdated.
+
+    :rtype: dict
+    """
+    try:
+        with open(FILE_INDEX, "r") as f:
+            index = loads(f.read())
+    except Exception:
+        return dict()
+
+    if not isinstance(index, dict) or index.get("version") != VERSION_INDEX:
+        return dict()
+
+    try:
+        return { directory: { "tag": info["tag"], "files": { name_file: TupleIndexEntry(*entry) for (name_file, entry) in info["files"].items() } } for (directory, info) in index["directories"].items() }
+    except Exception:
+        return dict()
+
+def save_index(index):
+    """
+    Save persistent name index, dropping directories which no longer exist. If the index cannot be written, the next run parses the policy files again. Nothing is saved in a dry run.
+
+    :type index: dict
+    """
+    if CHANGES.enabled:
+        return
+
+    try:
+        write_atomic(FILE_INDEX, dumps({ "version": VERSION_INDEX, "directories": { directory: info for (directory, info) in index.items() if Path(directory).is_dir() } }, separators=(",", ":")).encode())
+    except Exception:
+        pass
+
+def index_file(index, directory, tag, file_xml, name, uuid):
+    """
+    Add file written by this script to name index so it does not need to be parsed again.
+
+    :type index: dict
+    :type directory: Path
+    :type tag: str
+    :type file_xml: Path
+    :type name: str
+    :type uuid: str
+    """
+    info = index.get(str(directory))
+
+    if info is None or info["tag"] != tag:
+        return
+
+    try:
+        stat = file_xml.stat()
+    except OSError:
+        return
+
+    info["files"][file_xml.name] = TupleIndexEntry(mtime=stat.st_mtime_ns, size=stat.st_size, inode=stat.st_ino, name=name, uuid=uuid)
+
+def read_entry(file_xml, tag, cached):
+    """
+    Return index entry for file, parsing it only if it is new or changed (mtime, size or inode). Return None if the file is not a regular file.
+
+    :type file_xml: Path
+    :type tag: str
+    :type cached: TupleIndexEntry
+    :rtype: TupleIndexEntry
+    """
+    try:
+        stat = file_xml.stat()
+    except OSError:
+        return None
+
+    if not S_ISREG(stat.st_mode):
+        return None
+
+    if cached is not None and cached.mtime == stat.st_mtime_ns and cached.size == stat.st_size and cached.inode == stat.st_ino:
+        return cached
+
+    (name, uuid) = read_name(file_xml, tag)
+
+    return TupleIndexEntry(mtime=stat.st_mtime_ns, size=stat.st_size, inode=stat.st_ino, name=name, uuid=file_xml.stem if uuid is None else uuid)
+
+def scan_directories(list_location, index, workers=1):
+    """
+    Scan directories for Clearswift item lists or policy rules. Only files which are new or changed since the last scan are parsed. With more than one worker the files of all directories are read concurrently by a thread pool.
+
+    :type list_location: list
+    :type index: dict
+    :type workers: int
+    :rtype: list
+    """
+    list_task = list()
+
+    for (directory, tag) in list_location:
+        info = index.get(str(directory))
+
+        if info is None or info["tag"] != tag:
+            dict_cached = dict()
+        else:
+            dict_cached = info["files"]
+
+        for entry in directory.iterdir():
+            if entry.suffix == ".xml":
+                list_task.append((directory, entry, tag, dict_cached.get(entry.name)))
+
+    if workers > 1 and len(list_task) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list_entry = list(executor.map(lambda task: read_entry(*task[1:]), list_task))
+    else:
+        list_entry = [ read_entry(*task[1:]) for task in list_task ]
+
+    dict_directory = { directory: dict() for (directory, _) in list_location }
+
+    for ((directory, file_xml, _, _), entry) in zip(list_task, list_entry):
+        if entry is not None:
+            dict_directory[directory][file_xml.name] = entry
+
+    for (directory, tag) in list_location:
+        index[str(directory)] = { "tag": tag, "files": dict_directory[directory] }
+
+    return [ dict_directory[directory] for (directory, _) in list_location ]
+
+def scan_directory(directory, tag, index, workers=1):
+    """
+    Scan directory for Clearswift item lists or policy rules.
+
+    :type directory: Path
+    :type tag: str
+    :type index: dict
+    :type workers: int
+    :rtype: dict
+    """
+    return scan_directories([ (directory, tag), ], index, workers=workers)[0]
+
+def get_names(directory, tag, workers=1):
+    """
+    Get names of Clearswift item lists.
+
+    :type directory: Path
+    :type tag: str
+    :type workers: int
+    :rtype: set
+    """
+    index = load_index()
+
+    dict_file = scan_directory(directory, tag, index, workers=workers)
+
+    save_index(index)
+
+    return { entry.name for entry in dict_file.values() if entry.name is not None }
+
+class PolicyIndex:
+    """
+    Index of Clearswift policy rules and item lists shared across one install/update run.
+
+    Each directory is scanned at most once (backed by the persistent name index) and the index is kept up to date as files are written.
+    """
+    def __init__(self, gateway, workers=1, index=None):
+        """
+        :type gateway: TupleGateway
+        :type workers: int
+        :type index: dict
+        """
+        self.gateway = gateway
+        self.workers = workers
+        self.index = load_index() if index is None else index
+        self.dict_name = dict()
+        self.dict_uuid = dict()
+
+    def location(self, type_index):
+        """
+        Return directory and tag for index type (list type or rule).
+
+        :type type_index: str
+        :rtype: tuple
+        """
+        if type_index == TYPE_RULE:
+            return (self.gateway.directories[TYPE_RULE], TAG_RULE)
+
+        return (self.gateway.directories[type_index], LIST_INFO[type_index].tag)
+
+    def scan(self, *list_type):
+        """
+        Scan directories for index types which have not been scanned yet (all at the same time).
+
+        :type list_type: tuple
+        """
+        list_type = [ type_index for type_index in dict.fromkeys(list_type) if type_index not in self.dict_name ]
+
+        if not list_type:
+            return
+
+        list_location = [ self.location(type_index) for type_index in list_type ]
+
+        with TIMINGS.span(f"scan {', '.join(list_type)}"):
+            list_scanned = scan_directories(list_location, self.index, workers=self.workers)
+
+        for (type_index, (directory, _), dict_file) in zip(list_type, list_location, list_scanned):
+            dict_name = dict()
+            set_uuid = set()
+
+            for (name_file, entry) in dict_file.items():
+                set_uuid.add(Path(name_file).stem)
+                set_uuid.add(entry.uuid)
+
+                if entry.name is not None and entry.name not in dict_name:
+                    dict_name[entry.name] = directory / name_file
+
+            self.dict_name[type_index] = dict_name
+            self.dict_uuid[type_index] = set_uuid
+
+    def scan_all(self):
+        """
+        Scan directories of all list types and policy rules.
+        """
+        self.scan(TYPE_RULE, *LIST_INFO.keys())
+
+    def names(self, type_index):
+        """
+        Return names for index type.
+
+        :type type_index: str
+        :rtype: set
+        """
+        self.scan(type_index)
+
+        return self.dict_name[type_index].keys()
+
+    def lookup(self, type_index, name):
+        """
+        Return file path for name or None if not found.
+
+        :type type_index: str
+        :type name: str
+        :rtype: Path
+        """
+        self.scan(type_index)
+
+        return self.dict_name[type_index].get(name)
+
+    def new_file(self, type_index):
+        """
+        Generate uuid not used by any file of index type and return uuid and file path.
+
+        :type type_index: str
+        :rtype: tuple
+        """
+        self.scan(type_index)
+
+        (directory, _) = self.location(type_index)
+
+        set_uuid = self.dict_uuid[type_index]
+
+        while True:
+            uuid = str(generate_uuid())
+
+            if uuid not in set_uuid:
+                file_xml = directory / f"{uuid}.xml"
+
+                if not file_xml.exists():
+                    break
+
+        set_uuid.add(uuid)
+
+        return (uuid, file_xml)
+
+    def add(self, type_index, file_xml, name, uuid):
+        """
+        Add file written by this script to index.
+
+        :type type_index: str
+        :type file_xml: Path
+        :type name: str
+        :type uuid: str
+        """
+        self.scan(type_index)
+
+        (directory, tag) = self.location(type_index)
+
+        self.dict_name[type_index][name] = file_xml
+        self.dict_uuid[type_index].add(uuid)
+
+        # file is not written in dry run
+        if not CHANGES.enabled:
+            index_file(self.index, directory, tag, file_xml, name, uuid)
+
+    def save(self):
+        """
+        Save persistent name index.
+        """
+        save_index(self.index)
+
+def get_file_key(file_xml):
+    """
+    Return key identifying version of file (modification time, size and inode).
+
+    :type file_xml: Path
+    :rtype: list
+    """
+    try:
+        stat = file_xml.stat()
+    except Exception:
+        raise Exception(f"Cannot read file '{file_xml}'")
+
+    return [ stat.st_mtime_ns, stat.st_size, stat.st_ino ]
+
+def load_snapshot(file_xml, key):
+    """
+    Return snapshot of parsed file or None if missing or the file has changed since.
+
+    :type file_xml: Path
+    :type key: list
+    :rtype: dict
+    """
+    try:
+        with open(FILE_SNAPSHOT, "r") as f:
+            snapshot = loads(f.read())
+
+        if snapshot["version"] != VERSION_SNAPSHOT:
+            return None
+
+        entry = snapshot["files"][str(file_xml)]
+
+        if entry["key"] != key:
+            return None
+
+        return entry["data"]
+    except Exception:
+        return None
+
+def store_snapshot(file_xml, key, data):
+    """
+    Store snapshot of parsed file, dropping snapshots of files which no longer exist. Stores of concurrently processed gateway roots are serialized. Without a stored snapshot the file is parsed again on the next run. Nothing is stored in a dry run.
+
+    :type file_xml: Path
+    :type key: list
+    :type data: dict
+    """
+    if CHANGES.enabled:
+        return
+
+    with LOCK_SNAPSHOT:
+        try:
+            with open(FILE_SNAPSHOT, "r") as f:
+                snapshot = loads(f.read())
+
+            if snapshot["version"] != VERSION_SNAPSHOT:
+                raise Exception("Outdated snapshot")
+        except Exception:
+            snapshot = { "version": VERSION_SNAPSHOT, "files": dict() }
+
+        snapshot["files"] = { path: entry for (path, entry) in snapshot["files"].items() if Path(path).exists() }
+
+        snapshot["files"][str(file_xml)] = { "key": key, "data": data }
+
+        try:
+            write_atomic(FILE_SNAPSHOT, dumps(snapshot, separators=(",", ":")).encode())
+        except Exception:
+            pass
+
+def get_media_types(gateway):
+    """
+    Get Clearswift media type info, from snapshot if the media types file is unchanged.
+
+    :type gateway: TupleGateway
+    :rtype: dict
+    """
+    key = get_file_key(gateway.file_mediatypes)
+
+    snapshot = load_snapshot(gateway.file_mediatypes, key)
+
+    if snapshot is not None:
+        return { mnemonic: TupleMediaType(uuid, { sub_type for sub_type in MediaSubtype if mask & (1 << sub_type) }) for (mnemonic, (uuid, mask)) in snapshot.items() }
+
+    handler = HandlerMediaTypes()
+
+    parser = make_parser()
+    parser.setContentHandler(handler)
+
+    try:
+        parser.parse(str(gateway.file_mediatypes))
+    except SAXExceptionFinished:
+        pass
+
+    dict_media_type = handler.getMediaTypes()
+
+    # sub-types are stored as bitmask
+    store_snapshot(gateway.file_mediatypes, key, { mnemonic: [ media_type.uuid, sum(1 << sub_type for sub_type in media_type.sub_types) ] for (mnemonic, media_type) in dict_media_type.items() })
+
+    return dict_media_type
+
+def get_disposal_actions(gateway):
+    """
+    Get Clearswift disposal actions info, from snapshot if the disposals file is unchanged.
+
+    :type gateway: TupleGateway
+    :rtype: dict
+    """
+    key = get_file_key(gateway.file_disposal)
+
+    snapshot = load_snapshot(gateway.file_disposal, key)
+
+    if snapshot is not None:
+        return snapshot
+
+    handler = HandlerDisposalActions()
+
+    parser = make_parser()
+    parser.setContentHandler(handler)
+
+    try:
+        parser.parse(str(gateway.file_disposal))
+    except SAXExceptionFinished:
+        pass
+
+    dict_disposal_action = handler.getDisposalActions()
+
+    store_snapshot(gateway.file_disposal, key, dict_disposal_action)
+
+    return dict_disposal_action
+
+def render_items(info, iterable_item, dict_uuid=None):
+    """
+    Render list items lazily. Items found in dict of uuids keep their uuid (each uuid is only used once).
+
+    :type info: TupleInfo
+    :type iterable_item: iterable
+    :type dict_uuid: dict
+    :rtype: generator
+    """
+    for item in iterable_item:
+        uuid = None if dict_uuid is None else dict_uuid.pop(item, None)
+
+        yield info.template_item.substitute(item=info.process_item(item), uuid=generate_uuid() if uuid is None else uuid)
+
+def stream_list(f, info, name_list, uuid, iterable_item, dict_uuid=None):
+    """
+    Stream CS list to opened text file, identical to rendering the list template in one go. If the list template needs the item count and it is not known in advance, the rendered items are spooled to a temporary file first.
+
+    :type f: file
+    :type info: TupleInfo
+    :type name_list: str
+    :type uuid: str
+    :type iterable_item: iterable
+    :type dict_uuid: dict
+    """
+    (template_head, template_tail) = info.template_list.template.split("$items")
+
+    template_head = Template(template_head)
+    template_tail = Template(template_tail)
+
+    if "$count" not in template_head.template or hasattr(iterable_item, "__len__"):
+        f.write(template_head.substitute(name=quoteattr(name_list), uuid=uuid, count=len(iterable_item) if hasattr(iterable_item, "__len__") else 0))
+        f.writelines(render_items(info, iterable_item, dict_uuid=dict_uuid))
+    else:
+        with TemporaryFile("w+", buffering=SIZE_BUFFER) as f_spool:
+            count = 0
+
+            for item in render_items(info, iterable_item, dict_uuid=dict_uuid):
+                f_spool.write(item)
+
+                count += 1
+
+            f_spool.seek(0)
+
+            f.write(template_head.substitute(name=quoteattr(name_list), uuid=uuid, count=count))
+
+            copyfileobj(f_spool, f, SIZE_BUFFER)
+
+    f.write(template_tail.substitute())
+
+class SequenceCompare:
+    """
+    Iterable passing through items while comparing them with a reference sequence.
+    """
+    def __init__(self, iterable_item, list_reference):
+        """
+        :type iterable_item: iterable
+        :type list_reference: list
+        """
+        self.iterable_item = iterable_item
+        self.list_reference = list_reference
+        self.equal = True
+
+    def __iter__(self):
+        count = 0
+
+        for item in self.iterable_item:
+            if self.equal and (count >= len(self.list_reference) or item != self.list_reference[count]):
+                self.equal = False
+
+            count += 1
+
+            yield item
+
+        if count != len(self.list_reference):
+            self.equal = False
+
+class SizeCounter:
+    """
+    Text file replacement counting the UTF-8 encoded size of the text written to it.
+    """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        """
+        :type text: str
+        :rtype: int
+        """
+        self.size += len(text.encode())
+
+        return len(text)
+
+    def writelines(self, iterable_text):
+        """
+        :type iterable_text: iterable
+        """
+        for text in iterable_text:
+            self.write(text)
+
+def write_list(file_list, info, name_list, uuid, iterable_item, dict_uuid=None, list_existing=None, user=CS_USER, group=CS_GROUP):
+    """
+    Write CS list file, streaming items to the file in buffered chunks so memory usage does not depend on list size.
+
+    The list file is replaced atomically, keeping the mode of an existing list file. With a list of existing items, the list file is left untouched if the items are the same.
+
+    Return whether list file has been written.
+
+    :type file_list: Path
+    :type info: TupleInfo
+    :type name_list: str
+    :type uuid: str
+    :type iterable_item: iterable
+    :type dict_uuid: dict
+    :type list_existing: list
+    :type user: str
+    :type group: str
+    :rtype: bool
+    """
+    if list_existing is not None:
+        iterable_item = compare = SequenceCompare(iterable_item, list_existing)
+
+    def write_file(f):
+        stream_list(f, info, name_list, uuid, iterable_item, dict_uuid=dict_uuid)
+
+        return list_existing is None or not compare.equal
+
+    try:
+        try:
+            mode = file_list.stat().st_mode
+        except FileNotFoundError:
+            mode = None
+
+        return write_atomic(file_list, write_file, mode=mode, user=user, group=group, text=True)
+    except (OSError, LookupError, UnicodeError) as ex:
+        raise Exception(f"Cannot write list file '{file_list}'") from ex
+
+def get_items(file_list, info):
+    """
+    Get items and their uuids of CS list.
+
+    :type file_list: Path
+    :type info: TupleInfo
+    :rtype: list
+    """
+    handler = HandlerItems(info.tag_item)
+
+    parser = make_parser()
+    parser.setContentHandler(handler)
+
+    parser.parse(str(file_list))
+
+    return handler.getItems()
+
+def create_list(policy_index, type_list, name_list, list_item, replace=True, merge=False):
+    """
+    Create/replace CS list.
+
+    In merge mode the existing list is parsed: unchanged items keep their uuids, only added items get new ones and the file is only rewritten if the items differ. This needs the existing items in memory.
+
+    Return whether list file has been written.
+
+    :type policy_index: PolicyIndex
+    :type type_list: str
+    :type name_list: str
+    :type list_item: iterable
+    :type replace: bool
+    :type merge: bool
+    :rtype: bool
+    """
+    info = LIST_INFO[type_list]
+
+    file_list = policy_index.lookup(type_list, name_list)
+
+    dict_uuid = None
+    list_existing = None
+
+    exists = file_list is not None
+
+    if file_list is None:
+        (uuid, file_list) = policy_index.new_file(type_list)
+    elif replace:
+        uuid = file_list.stem
+
+        if merge:
+            try:
+                list_existing = get_items(file_list, info)
+            except Exception:
+                raise Exception(f"Cannot read list file '{file_list}'")
+
+            dict_uuid = dict()
+
+            for (item, uuid_item) in list_existing:
+                if uuid_item is not None:
+                    dict_uuid.setdefault(item, uuid_item)
+
+            list_existing = [ item for (item, _) in list_existing ]
+
+            if isinstance(list_item, list) and list_item == list_existing:
+                return False
+    else:
+        return False
+
+    if CHANGES.enabled:
+        # the list is streamed like by write_list, only counting its size
+        if list_existing is not None:
+            list_item = compare = SequenceCompare(list_item, list_existing)
+
+        counter = SizeCounter()
+
+        stream_list(counter, info, name_list, uuid, list_item, dict_uuid=dict_uuid)
+
+        if list_existing is not None and compare.equal:
+            return False
+
+        CHANGES.add(f"{'replace' if exists else 'create'} {type_list} list", file_list, size=counter.size)
+    elif not write_list(file_list, info, name_list, uuid, list_item, dict_uuid=dict_uuid, list_existing=list_existing, user=policy_index.gateway.user, group=policy_index.gateway.group):
+        return False
+
+    policy_index.add(type_list, file_list, name_list, uuid)
+
+    return True
+
+def hash_content(content):
+    """
+    Return SHA-256 hash of content.
+
+    :type content: str or bytes
+    :rtype: str
+    """
+    if isinstance(content, str):
+        content = content.encode()
+
+    return sha256(content).hexdigest()
+
+def file_unchanged(file_target, content):
+    """
+    Check whether existing file has the same content (by content hash).
+
+    :type file_target: Path
+    :type content: bytes
+    :rtype: bool
+    """
+    try:
+        with open(file_target, "rb") as f:
+            return hash_content(f.read()) == hash_content(content)
+    except Exception:
+        return False
+
+def list2set(list_in):
+    """
+    Create set from list and check for duplicate items.
+
+    :type list_in: list
+    :rtype: set
+    """
+    if list_in is None:
+        return None
+
+    set_out = set(list_in)
+
+    if len(set_out) < len(list_in):
+        raise Exception(f"Duplicate list items {str({ item for (item, count) in Counter(list_in).items() if count > 1 })[1:-1]}")
+
+    return set_out
+
+def read_items(file_input, column=None, delimiter=","):
+    """
+    Read list items from text file (one item per line) or column of CSV file, skipping empty items. Yields line number and item.
+
+    :type file_input: file
+    :type column: int
+    :type delimiter: str
+    :rtype: generator
+    """
+    if column is None:
+        for (number, line) in enumerate(file_input, start=1):
+            item = line.strip()
+
+            if item:
+                yield (number, item)
+    else:
+        csv = csv_reader(file_input, delimiter=delimiter)
+
+        for row in csv:
+            if len(row) >= column:
+                item = row[column - 1].strip()
+
+                if item:
+                    yield (csv.line_num, item)
+
+def validate_items(type_list, list_item):
+    """
+    Validate batch of list items. Return list of line numbers and items which are not valid.
+
+    Items must not contain characters not allowed in XML and items of address, filename and URL lists must not contain whitespace.
+
+    :type type_list: str
+    :type list_item: list
+    :rtype: list
+    """
+    if type_list == "lexical":
+        return [ (number, item) for (number, item) in list_item if REGEX_INVALID_XML.search(item) ]
+
+    return [ (number, item) for (number, item) in list_item if REGEX_INVALID_XML.search(item) or REGEX_WHITESPACE.search(item) ]
+
+def valid_items(type_list, iterable_item, batch=DEFAULT_BATCH, skip_invalid=False, counter=None):
+    """
+    Validate list items in batches. Invalid items are skipped (and counted) if requested, otherwise the first invalid items of the batch are reported in an exception.
+
+    :type type_list: str
+    :type iterable_item: iterable
+    :type batch: int
+    :type skip_invalid: bool
+    :type counter: Counter
+    :rtype: generator
+    """
+    iterator = iter(iterable_item)
+
+    while True:
+        list_item = list(islice(iterator, batch))
+
+        if not list_item:
+            break
+
+        list_invalid = validate_items(type_list, list_item)
+
+        if list_invalid:
+            if not skip_invalid:
+                raise Exception(f"Invalid list items {', '.join([ f'{repr(item)} (line {number})' for (number, item) in list_invalid[:10] ])}")
+
+            if counter is not None:
+                counter["invalid"] += len(list_invalid)
+
+            set_invalid = { number for (number, _) in list_invalid }
+
+            list_item = [ (number, item) for (number, item) in list_item if number not in set_invalid ]
+
+        for (_, item) in list_item:
+            yield item
+
+class UniqueItems:
+    """
+    Iterable of sorted unique list items with bounded memory usage (external merge sort).
+
+    At most the given number of items is held in memory, larger inputs are sorted in runs spooled to temporary files and merged. The number of unique and duplicate items is available after iterating.
+    """
+    def __init__(self, iterable_item, memory=DEFAULT_MEMORY):
+        """
+        :type iterable_item: iterable
+        :type memory: int
+        """
+        self.iterable_item = iterable_item
+        self.memory = memory
+        self.count = 0
+        self.duplicates = 0
+
+    def __iter__(self):
+        iterator = iter(self.iterable_item)
+
+        list_run = list()
+
+        try:
+            while True:
+                list_item = sorted(islice(iterator, self.memory))
+
+                if not list_item:
+                    break
+
+                if len(list_item) < self.memory and not list_run:
+                    yield from self.unique(list_item)
+
+                    return
+
+                f = TemporaryFile("w+")
+
+                list_run.append(f)
+
+                f.writelines(f"{dumps(item)}\n" for item in list_item)
+
+                f.seek(0)
+
+                del list_item
+
+            yield from self.unique(merge(*[ (loads(line) for line in f) for f in list_run ]))
+        finally:
+            for f in list_run:
+                f.close()
+
+    def unique(self, iterable_sorted):
+        """
+        Remove duplicates from sorted items.
+
+        :type iterable_sorted: iterable
+        :rtype: generator
+        """
+        previous = None
+
+        for item in iterable_sorted:
+            if item == previous:
+                self.duplicates += 1
+            else:
+                self.count += 1
+
+                yield item
+
+                previous = item
+
+def parse_config(command, configuration):
+    """
+    Parse external command config.
+
+    :type command: str
+    :type configuration: str
+    :rtype: dict
+    """
+    try:
+        dict_config = loads(configuration)
+    except Exception:
+        raise Exception("Config not valid JSON format")
+
+    configuration = dict()
+
+    for (name, rule) in dict_config.items():
+        if name in configuration:
+            raise Exception(f"Duplicate rule name '{name}'")
+
+        if KEY_MEDIA_TYPES in rule:
+            media_types = dict()
+
+            for (mnemonic, list_subtype) in rule[KEY_MEDIA_TYPES].items():
+                if mnemonic in media_types:
+                    raise Exception(f"Duplicate media type '{mnemonic}'")
+
+                if list_subtype is None:
+                    raise Exception(f"Media type '{mnemonic}' missing sub-types")
+
+                set_subtype = list2set(list_subtype)
+
+                invalid_subtype = set_subtype - MEDIA_SUBTYPE.keys()
+
+                if invalid_subtype:
+                    raise Exception(f"Invalid media sub-types '{invalid_subtype}'")
+
+                media_types[mnemonic] = { MEDIA_SUBTYPE[sub_type] for sub_type in set_subtype }
+        else:
+            raise Exception("Media types missing from config")
+
+        if KEY_RESPONSES in rule:
+            responses = dict()
+
+            for (action, description) in rule[KEY_RESPONSES].items():
+                if action not in RETURN_CODES:
+                    raise Exception(f"Invalid action '{action}'")
+
+                if action in responses:
+                    raise Exception(f"Duplicate action '{action}'")
+
+                responses[action] = description
+        else:
+            raise Exception("Responses missing from config")
+
+        if KEY_DISPOSAL_ACTIONS in rule:
+            disposal_actions = DICT_DISPOSAL.values()
+
+            if KEY_MODIFIED in rule[KEY_DISPOSAL_ACTIONS]:
+                modified = rule[KEY_DISPOSAL_ACTIONS][KEY_MODIFIED]
+
+                primary = modified.get(KEY_PRIMARY)
+
+                if primary is None:
+                    primary = DISPOSAL_NONE
+                elif primary not in disposal_actions and not primary.startswith("hold:"):
+                    raise Exception(f"Modified disposal has invalid primary action '{primary}'")
+
+                secondary = modified.get(KEY_SECONDARY)
+
+                if secondary is None:
+                    secondary = DISPOSAL_NONE
+                elif secondary not in disposal_actions and not secondary.startswith("hold:"):
+                    raise Exception(f"Modified disposal has invalid secondary action '{secondary}'")
+
+                modified = TupleAction(primary=primary, secondary=secondary)
+            else:
+                modified = TupleAction(primary=DISPOSAL_NONE, secondary=DISPOSAL_NONE)
+
+            if KEY_DETECTED in rule[KEY_DISPOSAL_ACTIONS]:
+                detected = rule[KEY_DISPOSAL_ACTIONS][KEY_DETECTED]
+
+                primary = detected.get(KEY_PRIMARY)
+
+                if primary is None:
+                    primary = DISPOSAL_NONE
+                elif primary not in disposal_actions and not primary.startswith("hold:"):
+                    raise Exception(f"Detected disposal has invalid primary action '{primary}'")
+
+                secondary = detected.get(KEY_SECONDARY)
+
+                if secondary is None:
+                    secondary = DISPOSAL_NONE
+                elif secondary not in disposal_actions and not secondary.startswith("hold:"):
+                    raise Exception(f"Detected disposal has invalid secondary action '{secondary}'")
+
+                detected = TupleAction(primary=primary, secondary=secondary)
+            else:
+                detected = TupleAction(primary=DISPOSAL_NONE, secondary=DISPOSAL_NONE)
+
+            disposal_actions = TupleDisposalAction(modified=modified, detected=detected)
+        else:
+            disposal_actions = TupleDisposalAction(modified=TupleAction(primary=DISPOSAL_NONE, secondary=DISPOSAL_NONE) , detected=TupleAction(primary=DISPOSAL_NONE, secondary=DISPOSAL_NONE))
+
+        if KEY_CONFIG in rule:
+            config = dict()
+
+            for (key, parameter) in rule[KEY_CONFIG].items():
+                if key in config:
+                    raise Exception(f"Duplicate parameter '{key}'")
+
+                if not PARAMETER_TYPE in parameter:
+                    raise Exception(f"Parameter '{key}' missing type")
+
+                if not PARAMETER_DESCRIPTION in parameter:
+                    raise Exception(f"Parameter '{key}' missing description")
+
+                if not PARAMETER_VALUE in parameter:
+                    raise Exception(f"Parameter '{key}' missing value")
+
+                config[key] = TupleParameter(type=parameter[PARAMETER_TYPE], description=parameter[PARAMETER_DESCRIPTION], value=parameter[PARAMETER_VALUE])
+        else:
+            config = None
+
+        configuration[name] = TupleRule(
+            packages=list2set(rule.get(KEY_PACKAGES)),
+            modules=list2set(rule.get(KEY_MODULES)),
+            list_address=list2set(rule.get(KEY_LIST_ADDRESS)),
+            list_filename=list2set(rule.get(KEY_LIST_FILENAME)),
+            list_url=list2set(rule.get(KEY_LIST_URL)),
+            list_lexical=list2set(rule.get(KEY_LIST_LEXICAL)),
+            parameters=rule.get(KEY_PARAMETERS, PARAMETERS_CONFIG.format(name, command) if KEY_CONFIG in rule else PARAMETERS_NO_CONFIG.format(command)),
+            timeout=rule.get(KEY_TIMEOUT, TIMEOUT),
+            media_types=media_types,
+            responses=responses,
+            disposal_actions=disposal_actions,
+            config=config
+        )
+
+    return configuration
+
+def get_path_script(command):
+    """
+    Return path of external command script in repo.
 
     :type command: str
-    :type configuration: str
+    :rtype: str
+    """
+    return f"{command}/{command}.py"
+
+def get_path_config(command):
+    """
+    Return path of external command configuration in repo.
+
+    :type command: str
+    :rtype: str
+    """
+    return f"{command}/{FILE_CONFIG}"
+
+def download_artifacts(downloader, set_script, set_config, library=True, skip=frozenset()):
+    """
+    Download external command script, library and scripts and configurations of external commands concurrently. External command script and library in skip are not downloaded (None).
+
+    :type downloader: Downloader
+    :type set_script: set
+    :type set_config: set
+    :type library: bool
+    :type skip: set
+    :rtype: TupleArtifacts
+    """
+    dict_path = dict()
+
+    if library:
+        if FILE_COMMAND not in skip:
+            dict_path[FILE_COMMAND] = "external command script"
+
+        if FILE_LIBRARY not in skip:
+            dict_path[FILE_LIBRARY] = "external command library"
+
+    for command in sorted(set_script):
+        dict_path[get_path_script(command)] = "external command script"
+
+    for command in sorted(set_config):
+        dict_path[get_path_config(command)] = "external command configuration"
+
+    if not dict_path:
+        return TupleArtifacts(command=None, library=None, scripts=dict(), configs=dict())
+
+    with TIMINGS.span("download"):
+        dict_content = downloader.download_all(dict_path)
+
+    for (path, content) in dict_content.items():
+        CHANGES.add("download", downloader.get_url(path), size=len(content))
+
+    try:
+        return TupleArtifacts(
+            command=dict_content.get(FILE_COMMAND),
+            library=dict_content[FILE_LIBRARY].decode() if FILE_LIBRARY in dict_content else None,
+            scripts={ command: dict_content[get_path_script(command)].decode() for command in set_script },
+            configs={ command: dict_content[get_path_config(command)].decode() for command in set_config }
+        )
+    except UnicodeDecodeError:
+        raise Exception("Downloaded file not valid UTF-8")
+
+def install_updates(directory, set_installed, artifacts, policy_index):
+    """
+    Install external command script and library and update currently installed external commands. Only files whose content has changed are rewritten (the external command script atomically, keeping its mode and owner), files which have not been downloaded (known to be unchanged) are skipped.
+
+    Return dict of external command script, library and external commands with flag whether changed.
+
+    :type directory: Path
+    :type set_installed: set
+    :type artifacts: TupleArtifacts
+    :type policy_index: PolicyIndex
+    :rtype: dict
+    """
+    dict_changed = dict()
+
+    with TIMINGS.span(f"update {FILE_COMMAND}"):
+        dict_changed[FILE_COMMAND] = artifacts.command is not None and not file_unchanged(directory / FILE_COMMAND, artifacts.command)
+
+        if dict_changed[FILE_COMMAND] and CHANGES.enabled:
+            CHANGES.add("write file", directory / FILE_COMMAND, size=len(artifacts.command))
+        elif dict_changed[FILE_COMMAND]:
+            try:
+                try:
+                    stat = (directory / FILE_COMMAND).stat()
+                except FileNotFoundError:
+                    write_atomic(directory / FILE_COMMAND, artifacts.command)
+                else:
+                    write_atomic(directory / FILE_COMMAND, artifacts.command, mode=stat.st_mode, user=stat.st_uid, group=stat.st_gid)
+            except Exception:
+                raise Exception(f"Cannot write external command script '{directory / FILE_COMMAND}'")
+
+    with TIMINGS.span(f"update {FILE_LIBRARY}"):
+        dict_changed[FILE_LIBRARY] = artifacts.library is not None and create_list(policy_index, "lexical", NAME_LIBRARY, [ artifacts.library, ], merge=True)
+
+    for command in sorted(set_installed):
+        with TIMINGS.span(f"update {command}"):
+            dict_changed[command] = command in artifacts.scripts and create_list(policy_index, "lexical", NAME_COMMAND.format(command), [ artifacts.scripts[command], ], merge=True)
+
+    return dict_changed
+
+def materialize_scripts(interpreter, directory, dict_script):
+    """
+    Write library and external command scripts to directory as importable modules and precompile them to hash-checked bytecode with a single run of the interpreter. The lexical lists stay the source of truth, only files whose content has changed are rewritten and recompiled.
+
+    Return list of written files.
+
+    :type interpreter: Path
+    :type directory: Path
+    :type dict_script: dict
+    :rtype: list
+    """
+    list_written = list()
+
+    for (name_file, script) in sorted(dict_script.items()):
+        file_script = directory / name_file
+
+        content = script.encode()
+
+        if file_unchanged(file_script, content):
+            continue
+
+        list_written.append(file_script)
+
+        if CHANGES.enabled:
+            CHANGES.add("write script", file_script, size=len(content))
+
+            continue
+
+        try:
+            write_atomic(file_script, content)
+        except Exception:
+            raise Exception(f"Cannot write script file '{file_script}'")
+
+    if list_written and CHANGES.enabled:
+        CHANGES.add("compile scripts", directory, size=None, count=len(list_written))
+    elif list_written:
+        try:
+            with TIMINGS.span("compile scripts"):
+                run([ str(interpreter), "-m", "compileall", "-q", "-f", "--invalidation-mode", "checked-hash", *[ str(file_script) for file_script in list_written ] ], stdout=DEVNULL, stderr=DEVNULL, check=True)
+        except Exception:
+            raise Exception(f"Cannot compile script files {str([ str(file_script) for file_script in list_written ])[1:-1]}")
+
+    return list_written
+
+def get_scripts(artifacts, set_command):
+    """
+    Return dict of file name and content of library and external command scripts.
+
+    :type artifacts: TupleArtifacts
+    :type set_command: set
+    :rtype: dict
+    """
+    dict_script = dict()
+
+    if artifacts.library is not None:
+        dict_script[FILE_LIBRARY] = artifacts.library
+
+    for command in set_command & artifacts.scripts.keys():
+        dict_script[f"{command}.py"] = artifacts.scripts[command]
+
+    return dict_script
+
+def normalize_module(name):
+    """
+    Return normalized Python distribution name.
+
+    :type name: str
+    :rtype: str
+    """
+    return REGEX_NORMALIZE.sub("-", name).lower()
+
+def parse_version(version):
+    """
+    Return release segment of version as tuple of ints for comparison.
+
+    :type version: str
+    :rtype: tuple
+    """
+    match = REGEX_RELEASE.match(version)
+
+    if match is None:
+        return tuple()
+
+    return tuple(int(number) for number in match[1].split("."))
+
+def requirement_satisfied(installed, operator, version):
+    """
+    Check whether installed version satisfies version requirement.
+
+    :type installed: str
+    :type operator: str
+    :type version: str
+    :rtype: bool
+    """
+    if operator is None:
+        return True
+
+    if operator in { "==", "!=" } and version.endswith(".*"):
+        prefix = parse_version(version[:-2])
+
+        matched = parse_version(installed)[:len(prefix)] == prefix
+
+        return matched if operator == "==" else not matched
+
+    installed = parse_version(installed)
+    required = parse_version(version)
+
+    length = max(len(installed), len(required))
+
+    installed += (0, ) * (length - len(installed))
+    required += (0, ) * (length - len(required))
+
+    if operator == "==":
+        return installed == required
+    elif operator == "!=":
+        return installed != required
+    elif operator == ">=":
+        return installed >= required
+    elif operator == "<=":
+        return installed <= required
+    elif operator == ">":
+        return installed > required
+    elif operator == "<":
+        return installed < required
+    else:
+        # compatible release, e.g. ~=2.2 requires >=2.2 and ==2.*
+        prefix = parse_version(version)[:-1]
+
+        return installed >= required and installed[:len(prefix)] == prefix
+
+def get_distributions(interpreter):
+    """
+    Get installed Python distributions and versions of interpreter. The current interpreter is checked in-process, otherwise the interpreter is run once without invoking pip.
+
+    :type interpreter: Path
+    :rtype: dict
+    """
+    if interpreter.resolve() == Path(executable).resolve():
+        list_distribution = [ (distribution.metadata["Name"], distribution.version) for distribution in distributions() ]
+    else:
+        try:
+            list_distribution = loads(run([ str(interpreter), "-c", SCRIPT_DISTRIBUTIONS ], stdout=PIPE, stderr=DEVNULL, check=True).stdout)
+        except Exception:
+            raise Exception(f"Cannot get installed Python modules of interpreter '{interpreter}'")
+
+    return { normalize_module(name): version for (name, version) in list_distribution if name }
+
+def get_new_areas(dict_config, dict_disposal_action):
+    """
+    Get Hold Areas used by rules of external command configurations which do not exist yet and generate uuids for them.
+
+    :type dict_config: dict
+    :type dict_disposal_action: dict
+    :rtype: dict
+    """
+    set_uuid = set(dict_disposal_action.values())
+
+    dict_area = dict()
+
+    for command in sorted(dict_config.keys()):
+        for rule in dict_config[command].values():
+            for disposal_action in rule.disposal_actions:
+                for action in disposal_action:
+                    if action not in dict_disposal_action and action not in dict_area:
+                        while True:
+                            uuid = str(generate_uuid())
+
+                            if uuid not in set_uuid:
+                                break
+
+                        set_uuid.add(uuid)
+
+                        dict_area[action] = uuid
+
+    return dict_area
+
+def add_areas(gateway, dict_area):
+    """
+    Add Message Areas for Hold Areas to disposal actions file in a single atomic rewrite.
+
+    :type gateway: TupleGateway
+    :type dict_area: dict
+    """
+    if not dict_area:
+        return
+
+    file_disposal = gateway.file_disposal
+
+    try:
+        with open(file_disposal, "rb") as f:
+            content = f.read()
+
+        stat = file_disposal.stat()
+    except Exception:
+        raise Exception(f"Cannot read disposal actions file '{file_disposal}'")
+
+    position = content.rfind(TAG_DISPOSAL_END)
+
+    if position == -1 or content[position + len(TAG_DISPOSAL_END):].strip():
+        raise Exception(f"Disposal actions file '{file_disposal}' does not end with closing tag")
+
+    areas = "".join([ TEMPLATE_AREA.substitute(name=quoteattr(action[5:]), uuid=uuid) for (action, uuid) in dict_area.items() ]).encode()
+
+    if CHANGES.enabled:
+        CHANGES.add("add Hold Areas", file_disposal, size=len(areas), count=len(dict_area))
+
+        return
+
+    try:
+        write_atomic(file_disposal, content[:position] + areas + content[position:], mode=stat.st_mode, user=stat.st_uid, group=stat.st_gid)
+    except Exception:
+        raise Exception(f"Cannot write disposal actions file '{file_disposal}'")
+
+def get_packages(dict_config):
+    """
+    Get system packages required by rules of external command configurations.
+
+    :type dict_config: dict
+    :rtype: set
+    """
+    set_package = set()
+
+    for config in dict_config.values():
+        for rule in config.values():
+            if rule.packages:
+                set_package |= rule.packages
+
+    return set_package
+
+def install_packages(set_package):
+    """
+    Install system packages not yet installed (checked with a single rpm database query) in a single yum transaction.
+
+    Return list of installed packages.
+
+    :type set_package: set
+    :rtype: list
+    """
+    if not set_package:
+        return list()
+
+    packages = sorted(set_package)
+
+    try:
+        output = run([ "/usr/bin/rpm", "-q", *packages ], stdout=PIPE, stderr=DEVNULL, env={ **environ, "LC_ALL": "C" }).stdout.decode()
+    except Exception:
+        raise Exception("Cannot query installed packages")
+
+    list_install = [ package for package in packages if f"package {package} is not installed" in output.split("\n") ]
+
+    if list_install and CHANGES.enabled:
+        CHANGES.add("install packages", ", ".join(list_install), size=None, count=len(list_install))
+
+        return list()
+
+    if list_install:
+        try:
+            run([ "/usr/bin/yum", "install", "-y", *list_install ], stdout=DEVNULL, stderr=DEVNULL, check=True)
+        except Exception:
+            raise Exception(f"Cannot install packages {str(list_install)[1:-1]}")
+
+    return list_install
+
+def get_modules(dict_config):
+    """
+    Get Python modules required by library and rules of external command configurations.
+
+    :type dict_config: dict
+    :rtype: set
+    """
+    set_module = set(MODULES_LIBRARY)
+
+    for config in dict_config.values():
+        for rule in config.values():
+            if rule.modules:
+                set_module |= rule.modules
+
+    return set_module
+
+def install_modules(interpreter, set_module, upgrade=False, wheelhouse=None):
+    """
+    Install missing or outdated Python modules with a single pip run. With upgrade all modules are passed to pip for upgrading. With a wheelhouse the modules are installed from it without index access.
+
+    Return list of modules passed to pip.
+
+    :type interpreter: Path
+    :type set_module: set
+    :type upgrade: bool
+    :type wheelhouse: Path
+    :rtype: list
+    """
+    if upgrade:
+        list_install = sorted(set_module)
+    else:
+        dict_distribution = get_distributions(interpreter)
+
+        list_install = list()
+
+        for module in sorted(set_module):
+            match = REGEX_REQUIREMENT.match(module)
+
+            if match is None:
+                list_install.append(module)
+
+                continue
+
+            installed = dict_distribution.get(normalize_module(match[1]))
+
+            if installed is None or not requirement_satisfied(installed, match[2], match[3]):
+                list_install.append(module)
+
+    if list_install and CHANGES.enabled:
+        CHANGES.add("install Python modules", ", ".join(list_install), size=None, count=len(list_install))
+
+        return list()
+
+    if list_install:
+        if wheelhouse is None:
+            list_option = list()
+        else:
+            list_option = [ "--no-index", "--find-links", str(wheelhouse) ]
+
+        try:
+            run([ str(interpreter), "-m", "pip", "install", "--upgrade", *list_option, *list_install ], stdout=DEVNULL, stderr=DEVNULL, check=True)
+        except Exception:
+            raise Exception(f"Cannot install Python modules {str(list_install)[1:-1]}")
+
+    return list_install
+
+def build_wheelhouse(interpreter, set_module, wheelhouse):
+    """
+    Resolve Python modules and build wheels for them and all their dependencies in wheelhouse directory.
+
+    :type interpreter: Path
+    :type set_module: set
+    :type wheelhouse: Path
+    """
+    try:
+        wheelhouse.mkdir(parents=True, exist_ok=True)
+    except Exception:
+        raise Exception(f"Cannot create wheelhouse directory '{wheelhouse}'")
+
+    modules = sorted(set_module)
+
+    try:
+        run([ str(interpreter), "-m", "pip", "wheel", "--wheel-dir", str(wheelhouse), *modules ], stdout=DEVNULL, stderr=DEVNULL, check=True)
+    except Exception:
+        raise Exception(f"Cannot build wheels for Python modules {str(modules)[1:-1]}")
+
+def write_bundle(file_bundle, plan, wheelhouse=None):
+    """
+    Write bundle archive with everything needed for installing external commands without network access: external command script, library, scripts and configurations of external commands, rendered lists, required packages and modules and optionally a wheelhouse. The archive is replaced atomically.
+
+    :type file_bundle: Path
+    :type plan: TuplePlan
+    :type wheelhouse: Path
+    """
+    dict_file = { FILE_COMMAND: plan.artifacts.command, FILE_LIBRARY: plan.artifacts.library.encode() }
+
+    for command in sorted(plan.configs.keys()):
+        dict_file[get_path_script(command)] = plan.artifacts.scripts[command].encode()
+        dict_file[get_path_config(command)] = plan.artifacts.configs[command].encode()
+
+    manifest = {
+        "version": VERSION_BUNDLE,
+        "commands": sorted(plan.configs.keys()),
+        "packages": sorted(plan.packages),
+        "modules": sorted(plan.modules),
+        "lists": { command: [ item_list._asdict() for item_list in plan.lists[command] ] for command in sorted(plan.configs.keys()) },
+        "files": { path: hash_content(content) for (path, content) in dict_file.items() }
+    }
+
+    def add_file(tar, name, content):
+        info = TarInfo(name)
+        info.size = len(content)
+        info.mtime = int(time())
+
+        tar.addfile(info, BytesIO(content))
+
+    def write_file(f):
+        with open_tar(fileobj=f, mode="w:gz") as tar:
+            add_file(tar, FILE_BUNDLE, dumps(manifest, indent=4).encode())
+
+            for (path, content) in dict_file.items():
+                add_file(tar, f"{DIR_BUNDLE_FILES}/{path}", content)
+
+            if wheelhouse is not None:
+                for file_wheel in sorted(wheelhouse.glob("*.whl")):
+                    tar.add(file_wheel, arcname=f"{DIR_BUNDLE_WHEELS}/{file_wheel.name}")
+
+        return True
+
+    try:
+        write_atomic(file_bundle, write_file)
+    except Exception:
+        raise Exception(f"Cannot write bundle file '{file_bundle}'")
+
+def read_bundle(file_bundle, wheelhouse):
+    """
+    Read bundle archive, check the content hashes of its files and extract its wheels to wheelhouse directory. The configurations are parsed again, which is fast and keeps the bundle independent of the internal representation of rules.
+
+    Return installation plan and whether the bundle contains wheels.
+
+    :type file_bundle: Path
+    :type wheelhouse: Path
+    :rtype: tuple
+    """
+    try:
+        tar = open_tar(file_bundle, "r:gz")
+    except Exception:
+        raise Exception(f"Cannot open bundle file '{file_bundle}'")
+
+    with tar:
+        try:
+            manifest = loads(tar.extractfile(FILE_BUNDLE).read())
+        except Exception:
+            raise Exception(f"Bundle file '{file_bundle}' has no valid manifest")
+
+        if manifest.get("version") != VERSION_BUNDLE:
+            raise Exception(f"Unsupported version of bundle file '{file_bundle}'")
+
+        dict_file = dict()
+
+        for (path, hash_file) in manifest["files"].items():
+            try:
+                content = tar.extractfile(f"{DIR_BUNDLE_FILES}/{path}").read()
+            except Exception:
+                raise Exception(f"Bundle file '{file_bundle}' is missing file '{path}'")
+
+            if hash_content(content) != hash_file:
+                raise Exception(f"File '{path}' of bundle file '{file_bundle}' is corrupted")
+
+            dict_file[path] = content
+
+        wheels = False
+
+        # only plain wheel files are extracted, never paths taken from the archive
+        for member in tar.getmembers():
+            name_wheel = member.name[len(DIR_BUNDLE_WHEELS) + 1:]
+
+            if member.isfile() and member.name.startswith(f"{DIR_BUNDLE_WHEELS}/") and "/" not in name_wheel and name_wheel.endswith(".whl"):
+                try:
+                    with open(wheelhouse / name_wheel, "wb") as f:
+                        copyfileobj(tar.extractfile(member), f, SIZE_BUFFER)
+                except Exception:
+                    raise Exception(f"Cannot extract wheel '{name_wheel}' of bundle file '{file_bundle}'")
+
+                wheels = True
+
+    set_command = set(manifest["commands"])
+
+    try:
+        artifacts = TupleArtifacts(
+            command=dict_file[FILE_COMMAND],
+            library=dict_file[FILE_LIBRARY].decode(),
+            scripts={ command: dict_file[get_path_script(command)].decode() for command in set_command },
+            configs={ command: dict_file[get_path_config(command)].decode() for command in set_command }
+        )
+    except KeyError:
+        raise Exception(f"Bundle file '{file_bundle}' is incomplete")
+    except UnicodeDecodeError:
+        raise Exception(f"Bundle file '{file_bundle}' not valid UTF-8")
+
+    plan = TuplePlan(
+        artifacts=artifacts,
+        configs={ command: parse_config(command, artifacts.configs[command]) for command in sorted(set_command) },
+        lists={ command: [ TupleList(**item_list) for item_list in manifest["lists"][command] ] for command in sorted(set_command) },
+        packages=set(manifest["packages"]),
+        modules=set(manifest["modules"])
+    )
+
+    return (plan, wheels)
+
+def write_worker_file(file_target, content, user=None, group=None):
+    """
+    Write file of resident worker if its content has changed, optionally changing its owner. Return whether written.
+
+    :type file_target: Path
+    :type content: str
+    :type user: str
+    :type group: str
+    :rtype: bool
+    """
+    content = content.encode()
+
+    if file_unchanged(file_target, content):
+        return False
+
+    if CHANGES.enabled:
+        CHANGES.add("write file", file_target, size=len(content))
+
+        return True
+
+    try:
+        file_target.parent.mkdir(parents=True, exist_ok=True)
+
+        write_atomic(file_target, content, user=user, group=group)
+    except Exception:
+        raise Exception(f"Cannot write resident worker file '{file_target}'")
+
+    return True
+
+def deploy_worker(args, gateway, set_module, set_command):
+    """
+    Deploy resident worker (server, client and systemd unit) which runs the external commands with preloaded Python modules, library and external command scripts. The modules are added to the ones preloaded so far. Return whether any file changed.
+
+    :type args: argparse.Namespace
+    :type gateway: TupleGateway
+    :type set_module: set
+    :type set_command: set
+    :rtype: bool
+    """
+    directory = get_rooted(gateway.root, args.directory)
+
+    set_distribution = set()
+
+    for module in set_module:
+        match = REGEX_REQUIREMENT.match(module)
+
+        if match is not None:
+            set_distribution.add(normalize_module(match.group(1)))
+
+    try:
+        with open(directory / FILE_SERVER_CONFIG, "r") as f:
+            set_distribution.update(loads(f.read())["modules"])
+    except FileNotFoundError:
+        pass
+    except Exception:
+        raise Exception(f"Cannot read resident worker config '{directory / FILE_SERVER_CONFIG}'")
+
+    # paths referenced by the worker are the ones on the gateway, not below the root
+    config = {
+        "socket": str(FILE_SOCKET),
+        "command": str(args.directory / FILE_COMMAND),
+        "library": str(args.directory / FILE_LIBRARY),
+        "commands": { NAME_COMMAND.format(command): str(args.directory / f"{command}.py") for command in sorted(set_command) },
+        "modules": sorted(set_distribution)
+    }
+
+    changed = write_worker_file(directory / FILE_SERVER_CONFIG, dumps(config, indent=4), gateway.user, gateway.group)
+
+    changed |= write_worker_file(directory / FILE_SERVER, TEMPLATE_SERVER.substitute(config=repr(str(args.directory / FILE_SERVER_CONFIG)), return_code_error=RETURN_CODE_ERROR), gateway.user, gateway.group)
+
+    changed |= write_worker_file(directory / FILE_CLIENT, TEMPLATE_CLIENT.substitute(socket=repr(str(FILE_SOCKET)), interpreter=repr(str(args.interpreter)), command=repr(str(args.directory / FILE_COMMAND)), return_code_error=RETURN_CODE_ERROR), gateway.user, gateway.group)
+
+    # worker runs external commands as the user Clearswift runs them as, which also owns the socket the client connects to
+    changed |= write_worker_file(get_rooted(gateway.root, FILE_UNIT), TEMPLATE_UNIT.substitute(user=args.worker_user, runtime=FILE_SOCKET.parent.name, interpreter=args.interpreter, server=args.directory / FILE_SERVER))
+
+    return changed
+
+def restart_worker():
+    """
+    Enable and restart resident worker.
+    """
+    if CHANGES.enabled:
+        CHANGES.add("restart resident worker", NAME_WORKER)
+
+        return
+
+    try:
+        with TIMINGS.span("restart resident worker"):
+            run([ "systemctl", "daemon-reload" ], stdout=DEVNULL, stderr=DEVNULL, check=True)
+            run([ "systemctl", "enable", NAME_WORKER ], stdout=DEVNULL, stderr=DEVNULL, check=True)
+            run([ "systemctl", "restart", NAME_WORKER ], stdout=DEVNULL, stderr=DEVNULL, check=True)
+    except Exception:
+        raise Exception("Cannot restart resident worker")
+
+def reload_webgui():
+    """
+    Reload Clearswift web interface.
+    """
+    try:
+        with TIMINGS.span("reload web interface"):
+            run("source /etc/profile.d/cs-vars.sh; /opt/cs-gateway/bin/cs-servicecontrol restart tomcat", shell=True, stdout=DEVNULL, stderr=DEVNULL, check=True)
+    except Exception:
+        raise Exception("Cannot restart Tomcat service")
+
+def apply_configuration(gateway):
+    """
+    Apply Clearswift configuration changes and reload web interface.
+
+    :type gateway: TupleGateway
+    """
+    try:
+        with open(gateway.file_apply, "w") as f:
+            f.write("reason:upgrade\ndetail:applied by external_commands")
+    except Exception:
+        raise Exception(f"Cannot write apply configuration file '{gateway.file_apply}'")
+
+    reload_webgui()
+
+@contextmanager
+def lock_gateway(gateway):
+    """
+    Hold exclusive lock on Clearswift configuration, serializing concurrent runs of this script. A dry run does not lock (nothing is written).
+
+    :type gateway: TupleGateway
+    :rtype: generator
+    """
+    if CHANGES.enabled:
+        yield
+
+        return
+
+    try:
+        gateway.file_lock.parent.mkdir(parents=True, exist_ok=True)
+
+        file_lock = open(gateway.file_lock, "a")
+    except Exception:
+        raise Exception(f"Cannot open lock file '{gateway.file_lock}'")
+
+    with file_lock:
+        with TIMINGS.span("wait for lock"):
+            flock(file_lock, LOCK_EX)
+
+        yield
+
+def read_reload(gateway):
+    """
+    Read state of pending apply/reload requests.
+
+    :type gateway: TupleGateway
     :rtype: dict
     """
     try:
-        dict_config = loads(configuration)
+        with open(gateway.file_reload, "r") as f:
+            return loads(f.read())
+    except FileNotFoundError:
+        return { "sequence": 0, "pending": False, "apply": False }
     except Exception:
-        raise Exception("Config not valid JSON format")
+        raise Exception(f"Cannot read reload state file '{gateway.file_reload}'")
 
-    configuration = dict()
+def write_reload(gateway, state):
+    """
+    Write state of pending apply/reload requests.
 
-    for (name, rule) in dict_config.items():
-        if name in configuration:
-            raise Exception(f"Duplicate rule name '{name}'")
+    :type gateway: TupleGateway
+    :type state: dict
+    """
+    try:
+        write_atomic(gateway.file_reload, dumps(state).encode())
+    except Exception:
+        raise Exception(f"Cannot write reload state file '{gateway.file_reload}'")
 
-        if KEY_MEDIA_TYPES in rule:
-            media_types = dict()
+def request_reload(gateway, apply):
+    """
+    Queue apply/reload request and return its sequence number. Requests are coalesced, the apply flag is kept until the pending requests are run.
+
+    :type gateway: TupleGateway
+    :type apply: bool
+    :rtype: int
+    """
+    with lock_gateway(gateway):
+        state = read_reload(gateway)
+
+        state["sequence"] += 1
+        state["pending"] = True
+        state["apply"] = state["apply"] or apply
+
+        write_reload(gateway, state)
+
+    return state["sequence"]
+
+def run_reload(gateway, sequence):
+    """
+    Apply configuration changes or reload web interface if the request with the sequence number is the last one queued. Return whether run.
+
+    :type gateway: TupleGateway
+    :type sequence: int
+    :rtype: bool
+    """
+    with lock_gateway(gateway):
+        state = read_reload(gateway)
+
+        if not state["pending"] or state["sequence"] != sequence:
+            return False
+
+        if state["apply"]:
+            apply_configuration(gateway)
+        else:
+            reload_webgui()
+
+        state["pending"] = False
+        state["apply"] = False
+
+        write_reload(gateway, state)
+
+    return True
+
+def defer_reload(gateway, sequence, debounce):
+    """
+    Run queued apply/reload request in detached background process after debounce window, so that back-to-back invocations result in a single apply/reload. Errors are logged to syslog.
+
+    :type gateway: TupleGateway
+    :type sequence: int
+    :type debounce: int
+    """
+    if fork():
+        return
+
+    try:
+        setsid()
+
+        with open("/dev/null", "r+") as f:
+            for fd in range(3):
+                dup2(f.fileno(), fd)
+
+        sleep(debounce)
+
+        if run_reload(gateway, sequence):
+            syslog(LOG_INFO, "external_commands: applied queued configuration changes")
+    except Exception as ex:
+        syslog(LOG_ERR, f"external_commands: {ex}")
+    finally:
+        _exit(ReturnCode.OK)
+
+def reload_configuration(args):
+    """
+    Queue apply/reload request if requested by options and run it immediately or after debounce window.
+
+    :type args: argparse.Namespace
+    """
+    if not (args.apply or args.reload):
+        return
+
+    if CHANGES.enabled:
+        CHANGES.add("apply configuration" if args.apply else "reload web interface", args.gateway.root)
+
+        return
+
+    sequence = request_reload(args.gateway, args.apply)
+
+    if args.debounce:
+        defer_reload(args.gateway, sequence, args.debounce)
+
+        print(f"{'Apply' if args.apply else 'Reload'} scheduled in {args.debounce} seconds")
+    elif not run_reload(args.gateway, sequence):
+        print(f"{'Apply' if args.apply else 'Reload'} left to concurrent run")
+
+def command_list(args, command_info):
+    """
+    List available external commands.
+
+    :type args: argparse.Namespace
+    :type command_info: dict
+    """
+    if args.json:
+        print(dumps({ command: { "description": entry["description"], "version": entry["version"] } for (command, entry) in sorted(args.catalog["commands"].items()) }, indent=4))
+
+        return
+
+    for command in sorted(command_info.keys()):
+        print(f"{command} - {command_info[command]}")
+
+def command_catalog(args, _):
+    """
+    Build catalog manifest for local copy of external commands repo.
+
+    :type args: argparse.Namespace
+    """
+    catalog = dumps(build_catalog(args.repo_directory), indent=4)
+
+    if args.output is None:
+        print(catalog)
+    else:
+        try:
+            with open(args.output, "w") as f:
+                f.write(catalog)
+        except Exception:
+            raise Exception(f"Cannot write catalog file '{args.output}'")
+
+def command_info(args, _):
+    """
+    Print information about external commands.
+
+    :type args: argparse.Namespace
+    """
+    list_command = sorted(args.command)
+
+    dict_readme = args.downloader.download_all({ f"{command}/{FILE_README}": "readme file" for command in list_command })
+
+    for command in list_command:
+        print(dict_readme[f"{command}/{FILE_README}"].decode())
+
+def status_changed(gateway):
+    """
+    Set Clearswift configuration status to changed.
+
+    :type gateway: TupleGateway
+    """
+    try:
+        with open(gateway.file_status, "r") as f:
+            content = f.read()
+    except Exception:
+        raise Exception(f"Cannot read status file '{gateway.file_status}'")
+
+    if CHANGES.enabled:
+        CHANGES.add("set configuration changed", gateway.file_status, size=len(content.encode()))
+
+        CHANGES.configuration = True
+
+        return
+
+    try:
+        with open(gateway.file_status, "w") as f:
+            f.write(content.replace(' changesMade="false" ', ' changesMade="true" '))
+    except Exception:
+        raise Exception(f"Cannot write status file '{gateway.file_status}'")
+
+def lock_gateways(list_gateway):
+    """
+    Hold exclusive locks on Clearswift configuration of all gateway roots (always acquired in the same order).
+
+    :type list_gateway: list
+    :rtype: ExitStack
+    """
+    stack = ExitStack()
+
+    try:
+        for gateway in sorted(list_gateway, key=lambda gateway: str(gateway.root)):
+            stack.enter_context(lock_gateway(gateway))
+    except BaseException:
+        stack.close()
+
+        raise
+
+    return stack
+
+def run_root(function, multiple):
+    """
+    Return function for gateway root task. With multiple roots an error is returned as result instead of raised, so the other roots are not aborted.
+
+    :type function: function
+    :type multiple: bool
+    :rtype: function
+    """
+    def run_function(dict_result):
+        try:
+            return function(dict_result)
+        except Exception as ex:
+            if not multiple:
+                raise
+
+            return ex
+
+    return run_function
+
+def get_root_results(dict_result, list_name):
+    """
+    Return results of gateway root tasks, raising the first error among them.
+
+    :type dict_result: dict
+    :type list_name: list
+    :rtype: list
+    """
+    list_result = [ dict_result[name] for name in list_name ]
+
+    for result in list_result:
+        if isinstance(result, Exception):
+            raise result
+
+    return list_result
+
+def report_roots(dict_result, action):
+    """
+    Print result for every gateway root and raise exception if any failed.
+
+    :type dict_result: dict
+    :type action: str
+    """
+    if len(dict_result) == 1:
+        return
+
+    # stdout of a dry run is reserved for the change plan
+    output = eprint if CHANGES.enabled else print
+
+    for (root, result) in dict_result.items():
+        output(f"{root} - {f'failed ({result})' if isinstance(result, Exception) else 'ok'}")
+
+    list_failed = [ str(root) for (root, result) in dict_result.items() if isinstance(result, Exception) ]
+
+    if list_failed:
+        raise Exception(f"{action} failed for roots {str(list_failed)[1:-1]}")
+
+def get_installed(command_info, policy_index):
+    """
+    Return external commands installed on gateway.
+
+    :type command_info: dict
+    :type policy_index: PolicyIndex
+    :rtype: set
+    """
+    set_lexical = policy_index.names("lexical")
+
+    return { command for command in command_info.keys() if NAME_COMMAND.format(command) in set_lexical }
+
+def install_dependencies(args, set_package, set_module):
+    """
+    Install system packages and Python modules (once per run, independent of the number of gateway roots).
+
+    :type args: argparse.Namespace
+    :type set_package: set
+    :type set_module: set
+    """
+    if set_package:
+        list_package = install_packages(set_package)
+
+        if list_package:
+            print(f"Installed packages {str(list_package)[1:-1]}")
+
+    if set_module:
+        install_modules(args.interpreter, set_module, upgrade=args.upgrade_modules, wheelhouse=args.wheelhouse)
+
+def render_lists(script, config):
+    """
+    Render lists of external command (script, parameters and lists used by policy rules).
+
+    :type script: str
+    :type config: dict
+    :rtype: list
+    """
+    list_list = list()
+
+    for (name, rule) in config.items():
+        if rule.config:
+            list_list.append(TupleList(type="lexical", name=NAME_CONFIG.format(name), items=[ TEMPLATE_PARAMETER.substitute(name=parameter, type=rule.config[parameter].type, description=rule.config[parameter].description, value=rule.config[parameter].value) for parameter in sorted(rule.config.keys()) ], replace=True))
+
+        for (type_list, set_name, item) in (("address", rule.list_address, "dummy@dummy.com"), ("filename", rule.list_filename, "dummy"), ("url", rule.list_url, "dummy.com"), ("lexical", rule.list_lexical, "dummy")):
+            if set_name:
+                for name_list in set_name:
+                    list_list.append(TupleList(type=type_list, name=name_list, items=[ item, ], replace=False))
+
+    return list_list
+
+def plan_install(artifacts, set_command):
+    """
+    Compute gateway independent part of installation once from downloaded files: parsed configs, rendered lists and required packages and modules.
+
+    :type artifacts: TupleArtifacts
+    :type set_command: set
+    :rtype: TuplePlan
+    """
+    dict_config = { command: parse_config(command, artifacts.configs[command]) for command in sorted(set_command) }
+
+    return TuplePlan(
+        artifacts=artifacts,
+        configs=dict_config,
+        lists={ command: render_lists(artifacts.scripts[command], dict_config[command]) for command in sorted(set_command) },
+        packages=get_packages(dict_config),
+        modules=get_modules(dict_config)
+    )
+
+def command_install(args, command_info):
+    """
+    Install external commands on one or more gateway roots.
+
+    Downloads, package and module installation and the scans and writes on each gateway root are run as task graph, so independent steps overlap.
+
+    :type args: argparse.Namespace
+    :type command_info: dict
+    """
+    index = load_index()
+
+    multiple = len(args.list_gateway) > 1
+
+    with lock_gateways(args.list_gateway):
+        list_index = [ PolicyIndex(gateway, workers=args.workers, index=index) for gateway in args.list_gateway ]
+
+        graph = TaskGraph()
+
+        graph.add("download commands", lambda dict_result: download_artifacts(args.downloader, args.command, args.command))
+        graph.add("parse configs", lambda dict_result: plan_install(dict_result["download commands"], args.command), depends=[ "download commands" ])
+
+        # gateway roots are only written after packages and modules have been installed, so a failed installation aborts before any change
+        if args.no_dependencies:
+            list_dependency = list()
+        else:
+            graph.add("install packages", lambda dict_result: install_dependencies(args, dict_result["parse configs"].packages, set()), depends=[ "parse configs" ])
+            graph.add("install modules", lambda dict_result: install_dependencies(args, set(), dict_result["parse configs"].modules), depends=[ "install packages" ])
+
+            list_dependency = [ "install modules", ]
 
-            for (mnemonic, list_subtype) in rule[KEY_MEDIA_TYPES].items():
-                if mnemonic in media_types:
-                    raise Exception(f"Duplicate media type '{mnemonic}'")
+        for policy_index in list_index:
+            root = policy_index.gateway.root
 
-                if list_subtype is None:
-                    raise Exception(f"Media type '{mnemonic}' missing sub-types")
+            graph.add(f"scan {root}", run_root(lambda dict_result, policy_index=policy_index: (policy_index.scan_all(), get_installed(command_info, policy_index))[1], multiple))
+            graph.add(f"read gateway {root}", run_root(lambda dict_result, gateway=policy_index.gateway: (get_media_types(gateway), get_disposal_actions(gateway)), multiple))
 
-                set_subtype = list2set(list_subtype)
+        list_scan = [ f"scan {policy_index.gateway.root}" for policy_index in list_index ]
 
-                invalid_subtype = set_subtype - MEDIA_SUBTYPE.keys()
+        # scripts of external commands already installed on any root are needed for updating them
+        graph.add("download installed", lambda dict_result: download_artifacts(args.downloader, set().union(*[ dict_result[name] for name in list_scan if not isinstance(dict_result[name], Exception) ]) - args.command, set(), library=False), depends=list_scan)
 
-                if invalid_subtype:
-                    raise Exception(f"Invalid media sub-types '{invalid_subtype}'")
+        for policy_index in list_index:
+            root = policy_index.gateway.root
 
-                media_types[mnemonic] = { MEDIA_SUBTYPE[sub_type] for sub_type in set_subtype }
-        else:
-            raise Exception("Media types missing from config")
+            def install(dict_result, policy_index=policy_index, root=root):
+                (set_installed, gateway_info) = get_root_results(dict_result, [ f"scan {root}", f"read gateway {root}" ])
 
-        if KEY_RESPONSES in rule:
-            responses = dict()
+                plan = dict_result["parse configs"]
 
-            for (action, description) in rule[KEY_RESPONSES].items():
-                if action not in RETURN_CODES:
-                    raise Exception(f"Invalid action '{action}'")
+                plan = plan._replace(artifacts=plan.artifacts._replace(scripts={ **plan.artifacts.scripts, **dict_result["download installed"].scripts }))
 
-                if action in responses:
-                    raise Exception(f"Duplicate action '{action}'")
+                with CHANGES.scope(root):
+                    install_root(args, plan, set_installed, gateway_info, policy_index)
 
-                responses[action] = description
-        else:
-            raise Exception("Responses missing from config")
+            graph.add(f"install {root}", run_root(install, multiple), depends=[ "parse configs", "download installed", f"scan {root}", f"read gateway {root}", *list_dependency ])
 
-        if KEY_DISPOSAL_ACTIONS in rule:
-            disposal_actions = DICT_DISPOSAL.values()
+        try:
+            dict_result = graph.run()
+        finally:
+            with TIMINGS.span("save index"):
+                save_index(index)
 
-            if KEY_MODIFIED in rule[KEY_DISPOSAL_ACTIONS]:
-                modified = rule[KEY_DISPOSAL_ACTIONS][KEY_MODIFIED]
+    report_roots({ policy_index.gateway.root: dict_result[f"install {policy_index.gateway.root}"] for policy_index in list_index }, "Installation")
 
-                primary = modified.get(KEY_PRIMARY)
+    reload_configuration(args)
 
-                if primary is None:
-                    primary = DISPOSAL_NONE
-                elif primary not in disposal_actions and not primary.startswith("hold:"):
-                    raise Exception(f"Modified disposal has invalid primary action '{primary}'")
+def install_root(args, plan, set_installed, gateway_info, policy_index):
+    """
+    Install external commands, policy rules, lists and Hold Areas on gateway root.
 
-                secondary = modified.get(KEY_SECONDARY)
+    :type args: argparse.Namespace
+    :type plan: TuplePlan
+    :type set_installed: set
+    :type gateway_info: tuple
+    :type policy_index: PolicyIndex
+    """
+    gateway = policy_index.gateway
 
-                if secondary is None:
-                    secondary = DISPOSAL_NONE
-                elif secondary not in disposal_actions and not secondary.startswith("hold:"):
-                    raise Exception(f"Modified disposal has invalid secondary action '{secondary}'")
+    set_lexical = policy_index.names("lexical")
 
-                modified = TupleAction(primary=primary, secondary=secondary)
-            else:
-                modified = TupleAction(primary=DISPOSAL_NONE, secondary=DISPOSAL_NONE)
+    duplicate = { NAME_COMMAND.format(command) for command in args.command } & set_lexical
 
-            if KEY_DETECTED in rule[KEY_DISPOSAL_ACTIONS]:
-                detected = rule[KEY_DISPOSAL_ACTIONS][KEY_DETECTED]
+    if duplicate:
+        raise Exception(f"External command scripts {str(duplicate)[1:-1]} already exist")
 
-                primary = detected.get(KEY_PRIMARY)
+    for config in plan.configs.values():
+        duplicate = config.keys() & policy_index.names(TYPE_RULE)
 
-                if primary is None:
-                    primary = DISPOSAL_NONE
-                elif primary not in disposal_actions and not primary.startswith("hold:"):
-                    raise Exception(f"Detected disposal has invalid primary action '{primary}'")
+        if duplicate:
+            raise Exception(f"Policy rules {str(duplicate)[1:-1]} already exist")
 
-                secondary = detected.get(KEY_SECONDARY)
+        duplicate = { NAME_CONFIG.format(name) for name in config.keys() } & set_lexical
 
-                if secondary is None:
-                    secondary = DISPOSAL_NONE
-                elif secondary not in disposal_actions and not secondary.startswith("hold:"):
-                    raise Exception(f"Detected disposal has invalid secondary action '{secondary}'")
+        if duplicate:
+            raise Exception(f"External command configurations {str(duplicate)[1:-1]} already exist")
 
-                detected = TupleAction(primary=primary, secondary=secondary)
-            else:
-                detected = TupleAction(primary=DISPOSAL_NONE, secondary=DISPOSAL_NONE)
+    (dict_media_type, dict_disposal_action) = gateway_info
 
-            disposal_actions = TupleDisposalAction(modified=modified, detected=detected)
-        else:
-            disposal_actions = TupleDisposalAction(modified=TupleAction(primary=DISPOSAL_NONE, secondary=DISPOSAL_NONE) , detected=TupleAction(primary=DISPOSAL_NONE, secondary=DISPOSAL_NONE))
+    install_updates(get_rooted(gateway.root, args.directory), set_installed, plan.artifacts, policy_index)
 
-        if KEY_CONFIG in rule:
-            config = dict()
+    if args.resident and deploy_worker(args, gateway, plan.modules, set_installed | args.command) and gateway.root == DEFAULT_ROOT:
+        restart_worker()
 
-            for (key, parameter) in rule[KEY_CONFIG].items():
-                if key in config:
-                    raise Exception(f"Duplicate parameter '{key}'")
+    with TIMINGS.span("add Hold Areas"):
+        dict_area = get_new_areas(plan.configs, dict_disposal_action)
 
-                if not PARAMETER_TYPE in parameter:
-                    raise Exception(f"Parameter '{key}' missing type")
+        add_areas(gateway, dict_area)
 
-                if not PARAMETER_DESCRIPTION in parameter:
-                    raise Exception(f"Parameter '{key}' missing description")
+    dict_disposal_action.update(dict_area)
 
-                if not PARAMETER_VALUE in parameter:
-                    raise Exception(f"Parameter '{key}' missing value")
+    if dict_area and not CHANGES.enabled:
+        # disposals file was rewritten with the new areas, so its content is known
+        store_snapshot(gateway.file_disposal, get_file_key(gateway.file_disposal), dict_disposal_action)
 
-                config[key] = TupleParameter(type=parameter[PARAMETER_TYPE], description=parameter[PARAMETER_DESCRIPTION], value=parameter[PARAMETER_VALUE])
-        else:
-            config = None
+    for command in sorted(args.command):
+        with TIMINGS.span(f"install {command}"):
+            install_command(args, command, plan, dict_media_type, dict_disposal_action, policy_index)
 
-        configuration[name] = TupleRule(
-            packages=list2set(rule.get(KEY_PACKAGES)),
-            modules=list2set(rule.get(KEY_MODULES)),
-            list_address=list2set(rule.get(KEY_LIST_ADDRESS)),
-            list_filename=list2set(rule.get(KEY_LIST_FILENAME)),
-            list_url=list2set(rule.get(KEY_LIST_URL)),
-            list_lexical=list2set(rule.get(KEY_LIST_LEXICAL)),
-            parameters=rule.get(KEY_PARAMETERS, PARAMETERS_CONFIG.format(name, command) if KEY_CONFIG in rule else PARAMETERS_NO_CONFIG.format(command)),
-            timeout=rule.get(KEY_TIMEOUT, TIMEOUT),
-            media_types=media_types,
-            responses=responses,
-            disposal_actions=disposal_actions,
-            config=config
-        )
+    materialize_scripts(args.interpreter, get_rooted(gateway.root, args.directory), get_scripts(plan.artifacts, set_installed | args.command))
 
-    return configuration
+    status_changed(gateway)
 
-def download_script(command):
+def install_command(args, command, plan, dict_media_type, dict_disposal_action, policy_index):
     """
-    Download external command script.
+    Install external command script, lists and policy rules of external command on gateway root.
 
+    :type args: argparse.Namespace
     :type command: str
-    :rtype: str
+    :type plan: TuplePlan
+    :type dict_media_type: dict
+    :type dict_disposal_action: dict
+    :type policy_index: PolicyIndex
     """
-    url_script = f"{URL_REPO}/{command}/{command}.py"
+    create_list(policy_index, "lexical", NAME_COMMAND.format(command), [ plan.artifacts.scripts[command], ])
 
-    try:
-        script = urlopen(url_script).read().decode()
-    except Exception:
-        raise Exception(f"Cannot download external command script '{url_script}'")
+    for item_list in plan.lists[command]:
+        create_list(policy_index, item_list.type, item_list.name, item_list.items, replace=item_list.replace)
 
-    return script
+    for (name, rule) in plan.configs[command].items():
+        (uuid, file_rule) = policy_index.new_file(TYPE_RULE)
 
-def install_updates(interpreter, directory, set_command, set_lexical, command_install=False):
-    """
-    Install external command script, library and Python dependencies and update currently installed external commands.
+        list_media_type = list()
 
-    :type interpreter: Path
-    :type directory: Path
-    :type set_command: set
-    :type set_lexial: set
-    :type command_install: bool
-    """
-    set_installed = { command for command in set_command if NAME_COMMAND.format(command) in set_lexical }
+        for (mnemonic, sub_types) in rule.media_types.items():
+            list_subtype = list()
 
-    if set_installed or command_install:
-        modules = sorted(MODULES_LIBRARY)
+            if MediaSubtype.ENCRYPTED in dict_media_type[mnemonic].sub_types and MediaSubtype.ENCRYPTED in sub_types:
+                list_subtype.append("enc")
 
-        try:
-            run(TEMPLATE_PIP.substitute(interpreter=interpreter, modules=" ".join(modules)), shell=True, stdout=DEVNULL, stderr=DEVNULL, check=True)
-        except Exception:
-            raise Exception(f"Cannot install Python modules {str(modules)[1:-1]}")
+            if MediaSubtype.SIGNED in dict_media_type[mnemonic].sub_types and MediaSubtype.SIGNED in sub_types:
+                list_subtype.append("digsign")
 
-        try:
-            urlretrieve(URL_COMMAND, directory / FILE_COMMAND)
-        except Exception:
-            raise Exception(f"Cannot download external command script '{URL_COMMAND}' to file '{directory / FILE_COMMAND}'")
+            if MediaSubtype.SIGNED_ENCRYPTED in dict_media_type[mnemonic].sub_types and MediaSubtype.SIGNED_ENCRYPTED in sub_types:
+                list_subtype.append("digsignenc")
 
-        try:
-            library = urlopen(URL_LIBRARY).read().decode()
-        except Exception:
-            raise Exception(f"Cannot download external command library '{URL_LIBRARY}'")
+            if MediaSubtype.DRM in dict_media_type[mnemonic].sub_types and MediaSubtype.DRM in sub_types:
+                list_subtype.append("drm")
 
-        create_list("lexical", NAME_LIBRARY, [ library, ])
+            if MediaSubtype.NOT_PROTECTED in dict_media_type[mnemonic].sub_types and MediaSubtype.NOT_PROTECTED in sub_types:
+                list_subtype.append("notprotect")
 
-    for command in set_installed:
-        create_list("lexical", NAME_COMMAND.format(command), [ download_script(command), ])
+            if list_subtype:
+                sub_types = f" {" ".join([ f'{subtype}="true"' for subtype in list_subtype ])}"
+            else:
+                sub_types = ""
 
-def reload_webgui():
-    """
-    Reload Clearswift web interface.
-    """
-    try:
-        run("source /etc/profile.d/cs-vars.sh; /opt/cs-gateway/bin/cs-servicecontrol restart tomcat", shell=True, stdout=DEVNULL, stderr=DEVNULL, check=True)
-    except Exception:
-        raise Exception("Cannot restart Tomcat service")
+            list_media_type.append(TEMPLATE_MEDIA.substitute(uuid=dict_media_type[mnemonic].uuid, sub_types=sub_types))
 
-def apply_configuration():
-    """
-    Apply Clearswift configuration changes and reload web interface.
-    """
-    try:
-        with open(FILE_APPLY, "w") as f:
-            f.write("reason:upgrade\ndetail:applied by external_commands")
-    except Exception:
-        raise Exception(f"Cannot write apply configuration file '{FILE_APPLY}'")
+        try:
+            content = TEMPLATE_RULE.substitute(
+                name=quoteattr(name),
+                uuid_rule=uuid,
+                media_types="".join(list_media_type),
+                uuid_media=generate_uuid(),
+                uuid_direction=generate_uuid(),
+                uuid_command=generate_uuid(),
+                command=escape(str(args.interpreter)),
+                parameters=escape(f"-I -S {args.directory / FILE_CLIENT} {rule.parameters}" if args.resident else f"{args.directory / FILE_COMMAND} {rule.parameters}"),
+                responses="".join([ TEMPLATE_RESPONSE.substitute(action=action, return_code=RETURN_CODES[action], description=description) for (action, description) in rule.responses.items() ]),
+                timeout=rule.timeout,
+                uuid_deliver=dict_disposal_action["deliver"],
+                uuid_none=dict_disposal_action["none"],
+                uuid_deliver_action=generate_uuid(),
+                uuid_deliver_web=generate_uuid(),
+                uuid_modified_primary=dict_disposal_action[rule.disposal_actions.modified.primary],
+                uuid_modified_secondary=dict_disposal_action[rule.disposal_actions.modified.secondary],
+                uuid_modified_action=generate_uuid(),
+                uuid_modified_web=generate_uuid(),
+                uuid_detected_primary=dict_disposal_action[rule.disposal_actions.detected.primary],
+                uuid_detected_secondary=dict_disposal_action[rule.disposal_actions.detected.secondary],
+                uuid_detected_action=generate_uuid(),
+                uuid_detected_web=generate_uuid()
+            )
+
+            if CHANGES.enabled:
+                CHANGES.add("create policy rule", file_rule, size=len(content.encode()))
+            else:
+                with open(file_rule, "w") as f:
+                    f.write(content)
 
-    reload_webgui()
+                chown(file_rule, user=policy_index.gateway.user, group=policy_index.gateway.group)
+        except Exception:
+            raise Exception(f"Cannot write policy rule file '{file_rule}'")
 
-def command_list(_, command_info):
-    """
-    List available external commands.
+        policy_index.add(TYPE_RULE, file_rule, name, uuid)
 
-    :type command_info: dict
+def command_update(args, command_info):
     """
-    for command in sorted(command_info.keys()):
-        print(f"{command} - {command_info[command]}")
+    Update installed external commands on one or more gateway roots.
 
-def command_info(args, _):
-    """
-    Print information about external commands.
+    Downloads, module installation and the scans and writes on each gateway root are run as task graph, so independent steps overlap.
 
     :type args: argparse.Namespace
+    :type command_info: dict
     """
-    for command in args.command:
-        url_readme = f"{URL_REPO}/{command}/{FILE_README}"
-
-        try:
-            readme = urlopen(url_readme).read().decode()
-        except Exception:
-            raise Exception(f"Cannot download readme file '{url_readme}'")
+    index = load_index()
 
-        print(readme)
+    multiple = len(args.list_gateway) > 1
 
-def status_changed():
-    """
-    Set Clearswift configuration status to changed.
-    """
-    try:
-        with open(FILE_STATUS, "r") as f:
-            content = f.read()
-    except Exception:
-        raise Exception(f"Cannot read status file '{FILE_STATUS}'")
+    dict_changed = dict()
 
-    try:
-        with open(FILE_STATUS, "w") as f:
-            f.write(content.replace(' changesMade="false" ', ' changesMade="true" '))
-    except Exception:
-        raise Exception(f"Cannot write status file '{FILE_STATUS}'")
+    with lock_gateways(args.list_gateway):
+        list_index = [ PolicyIndex(gateway, workers=args.workers, index=index) for gateway in args.list_gateway ]
 
-def command_install(args, command_info):
-    """
-    Install external commands.
+        graph = TaskGraph()
 
-    :type args: argparse.Namespace
-    :type command_info: dict
-    """
-    set_lexical = get_names(DIR_LEXICAL, "TextualAnalysis")
+        for policy_index in list_index:
+            graph.add(f"scan {policy_index.gateway.root}", run_root(lambda dict_result, policy_index=policy_index: get_installed(command_info, policy_index), multiple))
 
-    duplicate = { NAME_COMMAND.format(command) for command in args.command } & set_lexical
+        list_scan = [ f"scan {policy_index.gateway.root}" for policy_index in list_index ]
 
-    if duplicate:
-        raise Exception(f"External command scripts {str(duplicate)[1:-1]} already exist")
+        def download(dict_result):
+            set_installed = set().union(*[ dict_result[name] for name in list_scan if not isinstance(dict_result[name], Exception) ])
 
-    dict_media_type = get_media_types()
+            if not set_installed:
+                return None
 
-    dict_disposal_action = get_disposal_actions()
+            # files matching the content hashes of the repo on all roots are not downloaded again
+            set_unchanged = get_unchanged(get_hashes(args.catalog, args.downloader, set_installed), [ (policy_index, get_rooted(policy_index.gateway.root, args.directory)) for (policy_index, name) in zip(list_index, list_scan) if not isinstance(dict_result[name], Exception) ])
 
-    install_updates(args.interpreter, args.directory, command_info.keys(), set_lexical, command_install=True)
+            return download_artifacts(args.downloader, set_installed - set_unchanged, set(), skip=set_unchanged)
 
-    for command in args.command:
-        script = download_script(command)
+        graph.add("download updates", download, depends=list_scan)
 
-        url_config = f"{URL_REPO}/{command}/{FILE_CONFIG}"
+        # gateway roots are only written after modules have been installed, so a failed installation aborts before any change
+        if args.no_dependencies:
+            list_dependency = list()
+        else:
+            graph.add("install modules", lambda dict_result: install_dependencies(args, set(), MODULES_LIBRARY) if any(dict_result[name] and not isinstance(dict_result[name], Exception) for name in list_scan) else None, depends=list_scan)
 
-        try:
-            config = urlopen(url_config).read().decode()
-        except Exception:
-            raise Exception(f"Cannot download external command configuration '{url_config}'")
+            list_dependency = [ "install modules", ]
 
-        config = parse_config(command, config)
+        for policy_index in list_index:
+            root = policy_index.gateway.root
 
-        set_rule = get_names(DIR_RULES, "ExecutablePolicyRule")
+            def update(dict_result, policy_index=policy_index, root=root):
+                with CHANGES.scope(root):
+                    gateway = policy_index.gateway
 
-        duplicate = config.keys() & set_rule
+                    (set_installed, ) = get_root_results(dict_result, [ f"scan {root}" ])
 
-        if duplicate:
-            raise Exception(f"Policy rules {str(duplicate)[1:-1]} already exist")
+                    if set_installed:
+                        artifacts = dict_result["download updates"]
 
-        duplicate = { NAME_CONFIG.format(name) for name in config.keys() } & set_lexical
+                        dict_changed[root] = install_updates(get_rooted(root, args.directory), set_installed, artifacts, policy_index)
 
-        if duplicate:
-            raise Exception(f"External command configurations {str(duplicate)[1:-1]} already exist")
+                        materialize_scripts(args.interpreter, get_rooted(root, args.directory), get_scripts(artifacts, set_installed))
+                    else:
+                        dict_changed[root] = dict()
 
-        create_list("lexical", NAME_COMMAND.format(command), [ script, ])
+                    if args.resident and deploy_worker(args, gateway, MODULES_LIBRARY, set_installed) and root == DEFAULT_ROOT:
+                        restart_worker()
 
-        for (name, rule) in config.items():
-            if rule.packages:
-                for package in rule.packages:
-                    try:
-                        run([ "/usr/bin/yum", "install", "-y", package ], stdout=DEVNULL, stderr=DEVNULL, check=True)
-                    except Exception:
-                        raise Exception(f"Cannot install package '{package}'")
+                    # run_command.py is not part of the Clearswift configuration
+                    if any(changed for (name, changed) in dict_changed[root].items() if name != FILE_COMMAND):
+                        status_changed(gateway)
 
-            if rule.modules:
-                modules = sorted(rule.modules)
+            graph.add(f"update {root}", run_root(update, multiple), depends=[ "download updates", f"scan {root}", *list_dependency ])
 
-                try:
-                    run(TEMPLATE_PIP.substitute(interpreter=args.interpreter, modules=" ".join(modules)), shell=True, stdout=DEVNULL, stderr=DEVNULL, check=True)
-                except Exception:
-                    raise Exception(f"Cannot install Python modules {str(modules)[1:-1]}")
+        try:
+            dict_result = graph.run()
+        finally:
+            with TIMINGS.span("save index"):
+                save_index(index)
 
-            for disposal_action in rule.disposal_actions:
-                for action in disposal_action:
-                    if not action in dict_disposal_action:
-                        while True:
-                            uuid = generate_uuid()
+    for policy_index in list_index:
+        root = policy_index.gateway.root
 
-                            if uuid not in dict_disposal_action.values():
-                                break
+        # a dry run only prints the change plan
+        if CHANGES.enabled:
+            break
 
-                        try:
-                            with open(FILE_DISPOSAL, "r+b") as f:
-                                f.seek(-21, SEEK_END)
+        for (name, changed) in dict_changed.get(root, dict()).items():
+            if multiple:
+                print(f"{root}: {name} - {'changed' if changed else 'unchanged'}")
+            else:
+                print(f"{name} - {'changed' if changed else 'unchanged'}")
 
-                                f.write(TEMPLATE_AREA.substitute(name=quoteattr(action[5:]), uuid=uuid).encode())
-                        except Exception:
-                            raise Exception(f"Cannot write disposal actions file '{FILE_DISPOSAL}'")
+    report_roots({ policy_index.gateway.root: dict_result[f"update {policy_index.gateway.root}"] for policy_index in list_index }, "Update")
 
-                        dict_disposal_action[action] = uuid
+    if any(changed for dict_item in dict_changed.values() for (name, changed) in dict_item.items() if name != FILE_COMMAND):
+        reload_configuration(args)
 
-            if rule.config:
-                create_list("lexical", NAME_CONFIG.format(name), [ TEMPLATE_PARAMETER.substitute(name=parameter, type=rule.config[parameter].type, description=rule.config[parameter].description, value=rule.config[parameter].value) for parameter in sorted(rule.config.keys()) ])
+def command_import_list(args, _):
+    """
+    Import items from text or CSV file into address, filename, URL or lexical expression list.
 
-            if rule.list_address:
-                for name_list in rule.list_address:
-                    create_list("address", name_list, [ "dummy@dummy.com", ], replace=False)
+    :type args: argparse.Namespace
+    """
+    counter = Counter()
 
-            if rule.list_filename:
-                for name_list in rule.list_filename:
-                    create_list("filename", name_list, [ "dummy", ], replace=False)
+    try:
+        if args.file == "-":
+            file_input = stdin
+        else:
+            file_input = open(args.file, "r", newline="")
+    except Exception:
+        raise Exception(f"Cannot open input file '{args.file}'")
 
-            if rule.list_url:
-                for name_list in rule.list_url:
-                    create_list("url", name_list, [ "dummy.com", ], replace=False)
+    with lock_gateway(args.gateway):
+        policy_index = PolicyIndex(args.gateway, workers=args.workers)
 
-            if rule.list_lexical:
-                for name_list in rule.list_lexical:
-                    create_list("lexical", name_list, [ "dummy", ], replace=False)
+        try:
+            with file_input:
+                list_item = UniqueItems(valid_items(args.type, read_items(file_input, column=args.column, delimiter=args.delimiter), batch=args.batch, skip_invalid=args.skip_invalid, counter=counter), memory=args.memory)
 
-            while True:
-                uuid = generate_uuid()
-                file_rule = DIR_RULES / f"{uuid}.xml"
+                with TIMINGS.span(f"import {args.name}"):
+                    changed = create_list(policy_index, args.type, args.name, list_item, merge=args.merge)
+        finally:
+            with TIMINGS.span("save index"):
+                policy_index.save()
 
-                if not file_rule.exists():
-                    break
+        if changed:
+            status_changed(args.gateway)
 
-            list_media_type = list()
+    print(f"Imported {list_item.count} items into list '{args.name}' ({list_item.duplicates} duplicates, {counter['invalid']} invalid)")
 
-            for (mnemonic, sub_types) in rule.media_types.items():
-                list_subtype = list()
+    if not changed:
+        print(f"List '{args.name}' unchanged")
 
-                if MediaSubtype.ENCRYPTED in dict_media_type[mnemonic].sub_types and MediaSubtype.ENCRYPTED in sub_types:
-                    list_subtype.append("enc")
+        return
 
-                if MediaSubtype.SIGNED in dict_media_type[mnemonic].sub_types and MediaSubtype.SIGNED in sub_types:
-                    list_subtype.append("digsign")
+    reload_configuration(args)
 
-                if MediaSubtype.SIGNED_ENCRYPTED in dict_media_type[mnemonic].sub_types and MediaSubtype.SIGNED_ENCRYPTED in sub_types:
-                    list_subtype.append("digsignenc")
+def command_wheelhouse(args, _):
+    """
+    Build wheelhouse with Python modules required by library and external commands.
 
-                if MediaSubtype.DRM in dict_media_type[mnemonic].sub_types and MediaSubtype.DRM in sub_types:
-                    list_subtype.append("drm")
+    :type args: argparse.Namespace
+    """
+    artifacts = download_artifacts(args.downloader, set(), args.command, library=False)
 
-                if MediaSubtype.NOT_PROTECTED in dict_media_type[mnemonic].sub_types and MediaSubtype.NOT_PROTECTED in sub_types:
-                    list_subtype.append("notprotect")
+    build_wheelhouse(args.interpreter, get_modules({ command: parse_config(command, artifacts.configs[command]) for command in sorted(args.command) }), args.wheelhouse)
 
-                if list_subtype:
-                    sub_types = f" {" ".join([ f'{subtype}="true"' for subtype in list_subtype ])}"
-                else:
-                    sub_types = ""
+def command_export_bundle(args, _):
+    """
+    Export bundle with everything needed for installing external commands on gateways without network access.
 
-                list_media_type.append(TEMPLATE_MEDIA.substitute(uuid=dict_media_type[mnemonic].uuid, sub_types=sub_types))
+    :type args: argparse.Namespace
+    """
+    artifacts = download_artifacts(args.downloader, args.command, args.command)
 
-            try:
-                with open(file_rule, "w") as f:
-                    f.write(TEMPLATE_RULE.substitute(
-                        name=quoteattr(name),
-                        uuid_rule=uuid,
-                        media_types="".join(list_media_type),
-                        uuid_media=generate_uuid(),
-                        uuid_direction=generate_uuid(),
-                        uuid_command=generate_uuid(),
-                        command=escape(str(args.interpreter)),
-                        parameters=escape(f"{args.directory / FILE_COMMAND} {rule.parameters}"),
-                        responses="".join([ TEMPLATE_RESPONSE.substitute(action=action, return_code=RETURN_CODES[action], description=description) for (action, description) in rule.responses.items() ]),
-                        timeout=rule.timeout,
-                        uuid_deliver=dict_disposal_action["deliver"],
-                        uuid_none=dict_disposal_action["none"],
-                        uuid_deliver_action=generate_uuid(),
-                        uuid_deliver_web=generate_uuid(),
-                        uuid_modified_primary=dict_disposal_action[rule.disposal_actions.modified.primary],
-                        uuid_modified_secondary=dict_disposal_action[rule.disposal_actions.modified.secondary],
-                        uuid_modified_action=generate_uuid(),
-                        uuid_modified_web=generate_uuid(),
-                        uuid_detected_primary=dict_disposal_action[rule.disposal_actions.detected.primary],
-                        uuid_detected_secondary=dict_disposal_action[rule.disposal_actions.detected.secondary],
-                        uuid_detected_action=generate_uuid(),
-                        uuid_detected_web=generate_uuid()
-                    ))
-
-                chown(file_rule, user=CS_USER, group=CS_GROUP)
-            except Exception:
-                raise Exception(f"Cannot write policy rule file '{file_rule}'")
+    with TIMINGS.span("parse configs"):
+        plan = plan_install(artifacts, args.command)
 
-    status_changed()
+    with TemporaryDirectory() as directory:
+        if args.wheels:
+            with TIMINGS.span("build wheelhouse"):
+                build_wheelhouse(args.interpreter, plan.modules, Path(directory))
 
-    if args.apply:
-        apply_configuration()
-    elif args.reload:
-        reload_webgui()
+        with TIMINGS.span("write bundle"):
+            write_bundle(args.bundle, plan, wheelhouse=Path(directory) if args.wheels else None)
 
-def command_update(args, command_info):
+def command_import_bundle(args, _):
     """
-    Update installed external commands.
+    Install external commands from bundle without network access. Media types and disposal actions used by the policy rules are mapped to the uuids on the gateway.
 
-    :type command_info: dict
+    :type args: argparse.Namespace
     """
-    install_updates(args.interpreter, args.directory, command_info.keys(), get_names(DIR_LEXICAL, "TextualAnalysis"))
+    with TemporaryDirectory() as directory:
+        with TIMINGS.span("read bundle"):
+            (plan, wheels) = read_bundle(args.bundle, Path(directory))
+
+        args.command = set(plan.configs.keys())
+        args.wheelhouse = Path(directory) if wheels else None
+
+        if not args.no_dependencies:
+            with TIMINGS.span("install dependencies"):
+                install_dependencies(args, plan.packages, plan.modules)
+
+    with lock_gateway(args.gateway):
+        policy_index = PolicyIndex(args.gateway, workers=args.workers)
+
+        try:
+            with TIMINGS.span("read gateway"):
+                gateway_info = (get_media_types(args.gateway), get_disposal_actions(args.gateway))
 
-    status_changed()
+            install_root(args, plan, set(), gateway_info, policy_index)
+        finally:
+            with TIMINGS.span("save index"):
+                policy_index.save()
 
-    if args.apply:
-        apply_configuration()
-    elif args.reload:
-        reload_webgui()
+    reload_configuration(args)
 
 def main(args):
-    if hasattr(args, "directory"):
-        if not args.directory.exists():
-            eprint(f"Path '{args.directory}' does not exist")
+    if args.root is None:
+        args.root = [ DEFAULT_ROOT, ]
+
+    if len(args.root) > 1:
+        if args.action not in { command_install, command_update }:
+            eprint("Multiple roots only supported by install and update")
+
+            return ReturnCode.ERROR
+
+        if args.apply or args.reload:
+            eprint("Options -r and -a not supported with multiple roots, apply configuration to cluster afterwards")
 
             return ReturnCode.ERROR
 
-        if not args.directory.is_dir():
-            eprint(f"Path '{args.directory}' not a directory")
+        if len(set(args.root)) < len(args.root):
+            eprint("Duplicate roots")
 
             return ReturnCode.ERROR
 
+    if hasattr(args, "directory"):
+        for root in args.root:
+            directory = get_rooted(root, args.directory)
+
+            if not directory.exists():
+                eprint(f"Path '{directory}' does not exist")
+
+                return ReturnCode.ERROR
+
+            if not directory.is_dir():
+                eprint(f"Path '{directory}' not a directory")
+
+                return ReturnCode.ERROR
+
     if hasattr(args, "interpreter"):
         if not args.interpreter.exists():
             eprint("Path '{args.interpreter}' does not exist")
@@ -949,33 +4213,125 @@ def main(args):
 
             return ReturnCode.ERROR
 
-    command_info = get_commands()
+    if args.action in { command_install, command_update } and args.wheelhouse is not None and not args.wheelhouse.is_dir():
+        eprint(f"Wheelhouse '{args.wheelhouse}' not a directory")
+
+        return ReturnCode.ERROR
+
+    if hasattr(args, "debounce") and args.debounce < 0:
+        eprint("Debounce must not be negative")
+
+        return ReturnCode.ERROR
+
+    if hasattr(args, "workers") and args.workers < 1:
+        eprint("Number of workers must be at least 1")
+
+        return ReturnCode.ERROR
 
-    if hasattr(args, "command"):
-        args.command = set(args.command)
+    if args.action == command_import_list:
+        if args.column is not None and args.column < 1:
+            eprint("Column must be at least 1")
 
-        invalid_commands = args.command - command_info.keys()
+            return ReturnCode.ERROR
 
-        if invalid_commands:
-            eprint(f"Invalid external commands {str(invalid_commands)[1:-1]}")
+        if args.memory < 1 or args.batch < 1:
+            eprint("Memory and batch size must be at least 1")
 
             return ReturnCode.ERROR
 
+    (user, _, group) = args.owner.partition(":")
+
+    if not user or not group:
+        eprint(f"Invalid owner '{args.owner}'")
+
+        return ReturnCode.ERROR
+
+    args.list_gateway = [ get_gateway(root=root, user=user, group=group) for root in args.root ]
+
+    args.gateway = args.list_gateway[0]
+
+    args.downloader = Downloader(repo=args.repo, cache=None if args.no_cache else args.cache, hashes=load_hashes())
+
+    if args.timings is not None:
+        TIMINGS.enable()
+
+    if getattr(args, "plan", None) is not None:
+        CHANGES.enable()
+
+    if args.profile is None:
+        profile = None
+    else:
+        profile = Profile()
+
+        profile.enable()
+
     try:
+        if args.action in { command_import_list, command_catalog, command_import_bundle }:
+            args.catalog = { "files": dict(), "commands": dict() }
+        else:
+            with TIMINGS.span("download command list"):
+                args.catalog = get_catalog(args.downloader, refresh=args.action != command_list or args.refresh)
+
+        command_info = { command: entry["description"] for (command, entry) in args.catalog["commands"].items() }
+
+        if hasattr(args, "command"):
+            args.command = set(args.command)
+
+            invalid_commands = args.command - command_info.keys()
+
+            if invalid_commands:
+                eprint(f"Invalid external commands {str(invalid_commands)[1:-1]}")
+
+                return ReturnCode.ERROR
+
         args.action(args, command_info)
+
+        if CHANGES.enabled:
+            print(CHANGES.summary(args.plan))
     except Exception as ex:
         eprint(ex)
 
         return ReturnCode.ERROR
+    finally:
+        args.downloader.close()
+
+        if args.downloader.hashes_changed:
+            save_hashes(args.downloader.hashes)
+
+        if profile is not None:
+            profile.disable()
+
+            try:
+                profile.dump_stats(args.profile)
+            except Exception:
+                eprint(f"Cannot write profile file '{args.profile}'")
+
+        if args.timings is not None:
+            eprint(TIMINGS.summary(args.timings))
 
 if __name__ == "__main__":
     parser = ArgumentParser(description=DESCRIPTION)
 
     parser.set_defaults(action=parser.print_help)
+    parser.add_argument("--root", metavar="ROOT", type=Path, action="append", help=f"root directory of Clearswift gateway, install and update accept multiple roots (e.g. mounted peers) which are processed in parallel (default={DEFAULT_ROOT})")
+    parser.add_argument("--owner", metavar="USER:GROUP", type=str, default=f"{CS_USER}:{CS_GROUP}", help=f"owner of written Clearswift configuration files (default={CS_USER}:{CS_GROUP})")
+    parser.add_argument("--repo", metavar="REPO", type=str, default=URL_REPO, help=f"URL, file:// URL or local directory of external commands repo (default={URL_REPO})")
+    parser.add_argument("--cache", metavar="CACHE", type=Path, default=DEFAULT_CACHE, help=f"directory for caching downloaded files (default={DEFAULT_CACHE})")
+    parser.add_argument("--no-cache", action="store_true", help="do not cache downloaded files")
+    parser.add_argument("--timings", action="store_const", const=FORMAT_TABLE, help="print time spent in each phase and external command to stderr")
+    parser.add_argument("--timings-json", dest="timings", action="store_const", const=FORMAT_JSON, help="print time spent in each phase and external command to stderr in JSON format")
+    parser.add_argument("--profile", metavar="PROFILE", type=Path, help="profile run with cProfile and write statistics to .pstats file")
     subparsers = parser.add_subparsers()
 
     parser_list = subparsers.add_parser("list", help="list available external commands")
     parser_list.set_defaults(action=command_list)
+    parser_list.add_argument("--json", action="store_true", help="print external commands with description and version in JSON format")
+    parser_list.add_argument("--refresh", action="store_true", help="download catalog instead of using local copy")
+
+    parser_catalog = subparsers.add_parser("catalog", help="build catalog manifest for local copy of external commands repo")
+    parser_catalog.set_defaults(action=command_catalog)
+    parser_catalog.add_argument("repo_directory", metavar="DIRECTORY", type=Path, help="directory of external commands repo")
+    parser_catalog.add_argument("-o", "--output", metavar="OUTPUT", type=Path, help="write catalog to file instead of stdout")
 
     parser_info = subparsers.add_parser("info", help="print information about external commands")
     parser_info.set_defaults(action=command_info)
@@ -986,19 +4342,82 @@ if __name__ == "__main__":
     parser_install.add_argument("command", metavar="COMMAND", type=str, nargs="+", help="one or more external commands")
     parser_install.add_argument("-d", "--directory", metavar="DIRECTORY", type=Path, default=DEFAULT_DIRECTORY, help=f"directory for storing external command script (default={DEFAULT_DIRECTORY})")
     parser_install.add_argument("-i", "--interpreter", metavar="INTERPRETER", type=Path, default=DEFAULT_INTERPRETER, help=f"Python 3 interpreter used for running external command (default={DEFAULT_INTERPRETER})")
+    parser_install.add_argument("--no-dependencies", action="store_true", help="do not install system packages and Python modules")
+    parser_install.add_argument("--wheelhouse", metavar="WHEELHOUSE", type=Path, help="install Python modules from wheelhouse directory without index access")
+    parser_install.add_argument("-U", "--upgrade-modules", action="store_true", help="upgrade required Python modules even if already installed")
+    parser_install.add_argument("-w", "--workers", metavar="WORKERS", type=int, default=DEFAULT_WORKERS, help=f"number of threads for scanning policy directories, more than one only helps on a cold page cache (default={DEFAULT_WORKERS})")
+    parser_install.add_argument("--resident", action="store_true", help=f"run policy rules through resident worker with preloaded Python modules (systemd service '{NAME_WORKER}')")
+    parser_install.add_argument("--worker-user", metavar="USER", type=str, default=CS_COMMAND_USER, help=f"user running resident worker and owning its socket, has to be the user Clearswift runs external commands as (default={CS_COMMAND_USER})")
     parser_install.add_argument("-r", "--reload", action="store_true", help="reload Clearswift web interface")
     parser_install.add_argument("-a", "--apply", action="store_true", help="apply Clearswift configuration changes (and reload web interface)")
+    parser_install.add_argument("--debounce", metavar="SECONDS", type=int, default=DEFAULT_DEBOUNCE, help=f"apply/reload in background after SECONDS, coalescing requests of further runs within that window, 0 for immediate apply/reload (default={DEFAULT_DEBOUNCE})")
+    parser_install.add_argument("--plan", action="store_const", const=FORMAT_TABLE, help="dry run, print downloads, package and module installations and file changes with expected size and number of operations without making any changes")
+    parser_install.add_argument("--plan-json", dest="plan", action="store_const", const=FORMAT_JSON, help="dry run, print change plan in JSON format")
 
     parser_update = subparsers.add_parser("update", help="update all installed external commands to latest version")
     parser_update.set_defaults(action=command_update)
     parser_update.add_argument("-d", "--directory", metavar="DIRECTORY", type=Path, default=DEFAULT_DIRECTORY, help=f"directory for storing external command script (default={DEFAULT_DIRECTORY})")
     parser_update.add_argument("-i", "--interpreter", metavar="INTERPRETER", type=Path, default=DEFAULT_INTERPRETER, help=f"Python 3 interpreter used for running external command (default={DEFAULT_INTERPRETER})")
+    parser_update.add_argument("--no-dependencies", action="store_true", help="do not install system packages and Python modules")
+    parser_update.add_argument("--wheelhouse", metavar="WHEELHOUSE", type=Path, help="install Python modules from wheelhouse directory without index access")
+    parser_update.add_argument("-U", "--upgrade-modules", action="store_true", help="upgrade required Python modules even if already installed")
+    parser_update.add_argument("-w", "--workers", metavar="WORKERS", type=int, default=DEFAULT_WORKERS, help=f"number of threads for scanning policy directories, more than one only helps on a cold page cache (default={DEFAULT_WORKERS})")
+    parser_update.add_argument("--resident", action="store_true", help="update resident worker deployed with install --resident")
+    parser_update.add_argument("--worker-user", metavar="USER", type=str, default=CS_COMMAND_USER, help=f"user running resident worker and owning its socket, has to be the user Clearswift runs external commands as (default={CS_COMMAND_USER})")
     parser_update.add_argument("-r", "--reload", action="store_true", help="reload Clearswift web interface")
     parser_update.add_argument("-a", "--apply", action="store_true", help="apply Clearswift configuration changes (and reload web interface)")
+    parser_update.add_argument("--debounce", metavar="SECONDS", type=int, default=DEFAULT_DEBOUNCE, help=f"apply/reload in background after SECONDS, coalescing requests of further runs within that window, 0 for immediate apply/reload (default={DEFAULT_DEBOUNCE})")
+    parser_update.add_argument("--plan", action="store_const", const=FORMAT_TABLE, help="dry run, print downloads, package and module installations and file changes with expected size and number of operations without making any changes")
+    parser_update.add_argument("--plan-json", dest="plan", action="store_const", const=FORMAT_JSON, help="dry run, print change plan in JSON format")
+
+    parser_wheelhouse = subparsers.add_parser("wheelhouse", help="build wheelhouse with Python modules required by external commands")
+    parser_wheelhouse.set_defaults(action=command_wheelhouse)
+    parser_wheelhouse.add_argument("wheelhouse", metavar="WHEELHOUSE", type=Path, help="wheelhouse directory")
+    parser_wheelhouse.add_argument("command", metavar="COMMAND", type=str, nargs="*", help="zero or more external commands")
+    parser_wheelhouse.add_argument("-i", "--interpreter", metavar="INTERPRETER", type=Path, default=DEFAULT_INTERPRETER, help=f"Python 3 interpreter used for running external command (default={DEFAULT_INTERPRETER})")
+
+    parser_export_bundle = subparsers.add_parser("export-bundle", help="export bundle with everything needed for installing external commands without network access")
+    parser_export_bundle.set_defaults(action=command_export_bundle)
+    parser_export_bundle.add_argument("bundle", metavar="BUNDLE", type=Path, help="bundle file")
+    parser_export_bundle.add_argument("command", metavar="COMMAND", type=str, nargs="+", help="one or more external commands")
+    parser_export_bundle.add_argument("-i", "--interpreter", metavar="INTERPRETER", type=Path, default=DEFAULT_INTERPRETER, help=f"Python 3 interpreter used for building wheels (default={DEFAULT_INTERPRETER})")
+    parser_export_bundle.add_argument("--wheels", action="store_true", help="add wheels of required Python modules and their dependencies to bundle")
+
+    parser_import_bundle = subparsers.add_parser("import-bundle", help="install external commands from bundle without network access")
+    parser_import_bundle.set_defaults(action=command_import_bundle)
+    parser_import_bundle.add_argument("bundle", metavar="BUNDLE", type=Path, help="bundle file")
+    parser_import_bundle.add_argument("-d", "--directory", metavar="DIRECTORY", type=Path, default=DEFAULT_DIRECTORY, help=f"directory for storing external command script (default={DEFAULT_DIRECTORY})")
+    parser_import_bundle.add_argument("-i", "--interpreter", metavar="INTERPRETER", type=Path, default=DEFAULT_INTERPRETER, help=f"Python 3 interpreter used for running external command (default={DEFAULT_INTERPRETER})")
+    parser_import_bundle.add_argument("--no-dependencies", action="store_true", help="do not install system packages and Python modules")
+    parser_import_bundle.add_argument("-U", "--upgrade-modules", action="store_true", help="upgrade required Python modules even if already installed")
+    parser_import_bundle.add_argument("-w", "--workers", metavar="WORKERS", type=int, default=DEFAULT_WORKERS, help=f"number of threads for scanning policy directories, more than one only helps on a cold page cache (default={DEFAULT_WORKERS})")
+    parser_import_bundle.add_argument("--resident", action="store_true", help=f"run policy rules through resident worker with preloaded Python modules (systemd service '{NAME_WORKER}')")
+    parser_import_bundle.add_argument("--worker-user", metavar="USER", type=str, default=CS_COMMAND_USER, help=f"user running resident worker and owning its socket, has to be the user Clearswift runs external commands as (default={CS_COMMAND_USER})")
+    parser_import_bundle.add_argument("-r", "--reload", action="store_true", help="reload Clearswift web interface")
+    parser_import_bundle.add_argument("-a", "--apply", action="store_true", help="apply Clearswift configuration changes (and reload web interface)")
+    parser_import_bundle.add_argument("--debounce", metavar="SECONDS", type=int, default=DEFAULT_DEBOUNCE, help=f"apply/reload in background after SECONDS, coalescing requests of further runs within that window, 0 for immediate apply/reload (default={DEFAULT_DEBOUNCE})")
+    parser_import_bundle.add_argument("--plan", action="store_const", const=FORMAT_TABLE, help="dry run, print package and module installations and file changes with expected size and number of operations without making any changes")
+    parser_import_bundle.add_argument("--plan-json", dest="plan", action="store_const", const=FORMAT_JSON, help="dry run, print change plan in JSON format")
+
+    parser_import = subparsers.add_parser("import-list", help="import items from text or CSV file into address, filename, URL or lexical expression list")
+    parser_import.set_defaults(action=command_import_list)
+    parser_import.add_argument("type", metavar="TYPE", type=str, choices=sorted(LIST_INFO.keys()), help=f"list type ({', '.join(sorted(LIST_INFO.keys()))})")
+    parser_import.add_argument("name", metavar="NAME", type=str, help="list name (existing list is replaced)")
+    parser_import.add_argument("file", metavar="FILE", type=str, nargs="?", default="-", help="input file with one item per line, '-' for stdin (default=-)")
+    parser_import.add_argument("-c", "--column", metavar="COLUMN", type=int, help="read items from column of CSV input (starting at 1)")
+    parser_import.add_argument("--delimiter", metavar="DELIMITER", type=str, default=",", help="CSV delimiter (default=,)")
+    parser_import.add_argument("-m", "--memory", metavar="ITEMS", type=int, default=DEFAULT_MEMORY, help=f"maximum number of items held in memory for removing duplicates (default={DEFAULT_MEMORY})")
+    parser_import.add_argument("-b", "--batch", metavar="ITEMS", type=int, default=DEFAULT_BATCH, help=f"number of items validated per batch (default={DEFAULT_BATCH})")
+    parser_import.add_argument("--merge", action="store_true", help="merge into existing list, keeping uuids of unchanged items and only rewriting the list if items differ")
+    parser_import.add_argument("-s", "--skip-invalid", action="store_true", help="skip invalid items instead of aborting")
+    parser_import.add_argument("-w", "--workers", metavar="WORKERS", type=int, default=DEFAULT_WORKERS, help=f"number of threads for scanning policy directories, more than one only helps on a cold page cache (default={DEFAULT_WORKERS})")
+    parser_import.add_argument("-r", "--reload", action="store_true", help="reload Clearswift web interface")
+    parser_import.add_argument("-a", "--apply", action="store_true", help="apply Clearswift configuration changes (and reload web interface)")
+    parser_import.add_argument("--debounce", metavar="SECONDS", type=int, default=DEFAULT_DEBOUNCE, help=f"apply/reload in background after SECONDS, coalescing requests of further runs within that window, 0 for immediate apply/reload (default={DEFAULT_DEBOUNCE})")
 
     args = parser.parse_args()
 
-    if not args.action in { command_list, command_info, command_install, command_update }:
+    if not args.action in { command_list, command_info, command_install, command_update, command_wheelhouse, command_import_list, command_catalog, command_export_bundle, command_import_bundle }:
         args.action()
 
         exit(ReturnCode.OK)